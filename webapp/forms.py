@@ -15,11 +15,14 @@ class TaskGroupForm(ModelForm):
         labels = {
             'name': 'Group name',
             'description': 'Description',
-            'is_public': 'Public'
+            'is_public': 'Public',
+            'max_in_flight': 'Max. queued submissions'
         }
 
         help_texts = {
-            'is_public': 'determines whether group is public or not'
+            'is_public': 'determines whether group is public or not',
+            'max_in_flight': 'Limit of submissions to the group waiting for evaluation at once. '
+                             'Leave empty to use the default'
         }
 
     def __init__(self, *args, **kwargs):
@@ -76,7 +79,8 @@ class TaskForm(ModelForm):
             'submission_limit': 'Submissions limit',
             'result_type': 'Result priority',
             'files_count_limit': 'Max. files amount',
-            'file_size_limit': 'Max. file size'
+            'file_size_limit': 'Max. file size',
+            'reuse_evaluations': 'Reuse evaluations'
         }
 
         help_texts = {
@@ -86,10 +90,13 @@ class TaskForm(ModelForm):
             'result_type': 'Pattern, according to which results list will appear.',
             'submission_limit': 'Limit of submissions per user. Put 0 if unlimited',
             'files_count_limit': 'Maximal amount of files in one submission',
-            'file_size_limit': 'Maximal size of single file (in bytes)'
+            'file_size_limit': 'Maximal size of single file (in bytes)',
+            'reuse_evaluations': 'Identical resubmissions of a user get the previous result instead of '
+                                 'being evaluated again, until the task is changed'
         }
         widgets = {
-            'package': forms.FileInput
+            'package': forms.FileInput,
+            'reuse_evaluations': forms.Select(choices=((False, 'No'), (True, 'Yes')))
         }
 
     def __init__(self, *args, **kwargs):
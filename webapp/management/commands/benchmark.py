@@ -0,0 +1,321 @@
+import heapq
+import json
+import os
+import random
+import statistics
+import uuid
+
+import redis
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from django.core.cache import caches
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+
+import algoweb.settings
+from algoweb.settings import QUEUE_SCHEDULER
+from webapp.models import Submission, Task
+from webapp.utils.highlight import ListHtmlFormatter, highlight_file
+from webapp.utils.redis_facade import QUEUE_PRIORITIES, dispatch_scheduled, enqueue_submission, get_schedule
+
+
+class LegacyListHtmlFormatter(ListHtmlFormatter):
+    """
+    Formatter used before the lines were joined at once (repeated string concatenation)
+    """
+    @staticmethod
+    def _wrap_lines(source):
+        ln = ''
+        lc = ''
+        n = 0
+
+        for i, line in source:
+            if i == 1:
+                n += 1
+                f = ' first' if n == 1 else ''
+                ln += '<div class="l-num{}" data-n="{}">{}</div>'.format(f, n, n)
+                lc += '<div class="l-code{}" data-n="{}">{}</div>'.format(f, n, line)
+
+        yield 0, '<table><tr><td class="lines-gutter">{}</td><td class="code-content">{}</td></tr></table>'.format(ln,
+                                                                                                                   lc)
+
+
+class Command(BaseCommand):
+    help = "Runs micro-benchmarks of the performance critical paths against local services"
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=['enqueue', 'highlight', 'scheduler'])
+        parser.add_argument('--iterations', type=int, default=1000)
+        parser.add_argument('--files', type=int, default=3, help='Number of files per submission')
+        parser.add_argument('--file-size', type=int, default=4096, help='Size of a single file in bytes')
+        parser.add_argument('--lines', type=int, default=5000, help='Number of lines of the highlighted file')
+        parser.add_argument('--workers', type=int, default=4, help='Number of simulated workers')
+        parser.add_argument('--trace', help='Trace replayed by the scheduler simulation (JSON lines), '
+                                            'a generated deadline spike is used if not given')
+        parser.add_argument('--record-task', type=int,
+                            help='Records the submissions of the task to --trace instead of running the simulation')
+        parser.add_argument('--seed', type=int, default=1, help='Seed of the generated deadline spike')
+        parser.add_argument('--redis-db', type=int, default=15,
+                            help='Redis database used for the benchmark, it is flushed afterwards')
+
+    def report(self, name, timings):
+        timings = sorted(timings)
+        self.stdout.write('{:<12} mean {:8.3f} ms | median {:8.3f} ms | p95 {:8.3f} ms | total {:8.3f} s'.format(
+            name,
+            statistics.mean(timings) * 1000,
+            statistics.median(timings) * 1000,
+            timings[int(len(timings) * 0.95)] * 1000,
+            sum(timings)
+        ))
+
+    def get_bench_redis(self, db):
+        if db == algoweb.settings.REDIS_CONFIG.get('db', 0):
+            raise CommandError('Refusing to run the benchmark against the production Redis database')
+
+        config = algoweb.settings.REDIS_CONFIG.copy()
+        config['db'] = db
+        return redis.Redis(**config)
+
+    @staticmethod
+    def legacy_enqueue(rs, uuid, priority, files, queue_item):
+        """
+        Enqueue path used before the Lua script was introduced (one round trip per command)
+        """
+        rs.ping()
+
+        for name, contents in files:
+            rs.hset("submission:%s" % uuid, "file:%s" % name, contents)
+
+        seq = rs.incrby("queue:{}:counter".format(priority), 1)
+        rs.execute_command('ZADD', "queue:{}:order".format(priority), seq, uuid)
+        rs.rpush("queue:{}".format(priority), json.dumps(queue_item))
+
+        return seq
+
+    def bench_enqueue(self, options):
+        rs = self.get_bench_redis(options['redis_db'])
+        files = [('file{}.cpp'.format(i), os.urandom(options['file_size'])) for i in range(options['files'])]
+
+        self.stdout.write('Enqueue: {} iterations, {} files of {} bytes each'.format(
+            options['iterations'], options['files'], options['file_size']))
+
+        for name, enqueue in [('legacy', self.legacy_enqueue), ('script', enqueue_submission)]:
+            rs.flushdb()
+            timings = []
+
+            for i in range(options['iterations']):
+                sid = str(uuid.uuid4())
+                queue_item = {"uuid": sid, "package": {"name": "bench", "version": 1, "url": ""}}
+
+                start = perf_counter()
+                enqueue(rs, sid, 'medium', files, queue_item)
+                timings.append(perf_counter() - start)
+
+            self.report(name, timings)
+
+        rs.flushdb()
+
+    def bench_highlight(self, options):
+        line = 'for (int i = 0; i < n; ++i) { sum += values[i] * weights[i]; } // accumulate\n'
+        contents = ('#include <vector>\n' + line * (options['lines'] - 1)).encode('utf-8')
+        iterations = max(1, options['iterations'] // 100)
+
+        self.stdout.write('Highlight: {} iterations, file of {} lines ({} bytes)'.format(
+            iterations, options['lines'], len(contents)))
+
+        for name, formatter in [('legacy', LegacyListHtmlFormatter), ('linear', ListHtmlFormatter)]:
+            timings = []
+
+            for i in range(iterations):
+                start = perf_counter()
+                highlight_file('bench.cpp', contents, formatter())
+                timings.append(perf_counter() - start)
+
+            self.report(name, timings)
+
+        cache = caches['highlight']
+        cache.set('highlight:bench', highlight_file('bench.cpp', contents))
+        timings = []
+
+        for i in range(iterations):
+            start = perf_counter()
+            cache.get('highlight:bench')
+            timings.append(perf_counter() - start)
+
+        cache.delete('highlight:bench')
+        self.report('cached', timings)
+
+    @staticmethod
+    def generate_spike(seed):
+        """
+        Submissions during the last hour before a deadline, a task without deadline
+        and a bulk re-evaluation of another task invoked by the staff in the middle of the spike
+        :return: list of trace records
+        """
+        rnd = random.Random(seed)
+        trace = []
+
+        for user in range(150):
+            # most of the students submit during the last minutes, some of them several times
+            for attempt in range(rnd.randint(1, 6)):
+                trace.append({'t': max(0.0, 3600 - rnd.expovariate(1 / 600)), 'flow': 'user:{}'.format(user),
+                              'task': 1, 'priority': 'medium', 'took': rnd.gauss(3000, 800), 'deadline': 3600})
+
+        for user in range(150, 170):
+            for attempt in range(rnd.randint(1, 3)):
+                trace.append({'t': rnd.uniform(0, 3600), 'flow': 'user:{}'.format(user), 'task': 2,
+                              'priority': 'medium', 'took': rnd.gauss(2000, 500), 'deadline': None})
+
+        for i in range(300):
+            trace.append({'t': 3000.0, 'flow': 'invoker:1', 'task': 3, 'priority': 'low',
+                          'took': rnd.gauss(3000, 800), 'deadline': None})
+
+        return trace
+
+    def record_trace(self, task_id, path):
+        task = Task.objects.get(pk=task_id)
+        submissions = Submission.objects.filter(task=task).values_list(
+            'submitted', 'user_id', 'reevaluated', 'invoked_by_id', 'queue_priority',
+            'submissionevaluation__worker_took_time'
+        ).order_by('submitted')
+
+        if not submissions:
+            raise CommandError('The task has no submissions')
+
+        first = submissions[0][0]
+
+        with open(path, 'w') as f:
+            for submitted, user_id, reevaluated, invoker_id, priority, took in submissions:
+                f.write(json.dumps({
+                    't': (submitted - first).total_seconds(),
+                    'flow': 'invoker:{}'.format(invoker_id) if reevaluated else 'user:{}'.format(user_id),
+                    'task': task.id,
+                    'priority': priority,
+                    'took': took or 1000,
+                    'deadline': (task.deadline - first).total_seconds() if task.deadline else None
+                }) + '\n')
+
+        self.stdout.write('Recorded {} submissions to {}'.format(len(submissions), path))
+
+    @staticmethod
+    def simulate(rs, trace, workers, scheduled):
+        """
+        Replays the trace against Redis with simulated workers taking the items like the real ones
+        (from the highest priority list), the virtual clock advances with the arrivals and the finished evaluations
+        :return: (trace sorted by the arrival, dictionary trace index => waiting time in seconds)
+        """
+        rs.flushdb()
+        base = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        trace = sorted(trace, key=lambda record: record['t'])
+        lookup = {}
+        waits = {}
+        pending = defaultdict(int)
+        busy = []
+        idle = workers
+        i = 0
+
+        while i < len(trace) or busy:
+            next_arrival = trace[i]['t'] if i < len(trace) else float('inf')
+
+            if busy and busy[0][0] < next_arrival:
+                now, index = heapq.heappop(busy)
+                pending[trace[index]['flow']] -= 1
+                idle += 1
+            else:
+                now = next_arrival
+                record = trace[i]
+                sid = str(uuid.uuid4())
+                lookup[sid] = i
+
+                # the demotion done by task_submit
+                priority = 'low' if pending[record['flow']] >= 2 else record['priority']
+                pending[record['flow']] += 1
+
+                schedule = None
+
+                if scheduled:
+                    deadline = base + timedelta(seconds=record['deadline']) if record['deadline'] else None
+                    schedule = get_schedule(record['flow'], record['task'], priority, deadline,
+                                            base + timedelta(seconds=now))
+
+                queue_item = {"uuid": sid, "package": {"name": "bench", "version": 1, "url": ""}}
+                enqueue_submission(rs, sid, priority, [], queue_item, schedule=schedule)
+                i += 1
+
+            while idle:
+                if scheduled:
+                    dispatch_scheduled(rs, base + timedelta(seconds=now))
+
+                item = None
+
+                for priority in QUEUE_PRIORITIES:
+                    item = rs.lpop("queue:{}".format(priority))
+
+                    if item is not None:
+                        break
+
+                if item is None:
+                    break
+
+                index = lookup[json.loads(item.decode('utf-8'))['uuid']]
+                waits[index] = now - trace[index]['t']
+                heapq.heappush(busy, (now + max(trace[index]['took'], 1) / 1000, index))
+                idle -= 1
+
+        rs.flushdb()
+        return trace, waits
+
+    def bench_scheduler(self, options):
+        if options['record_task']:
+            if not options['trace']:
+                raise CommandError('--trace has to be given to record the task')
+
+            return self.record_trace(options['record_task'], options['trace'])
+
+        if options['trace']:
+            with open(options['trace']) as f:
+                trace = [json.loads(line) for line in f if line.strip()]
+        else:
+            trace = self.generate_spike(options['seed'])
+
+        rs = self.get_bench_redis(options['redis_db'])
+
+        self.stdout.write('Scheduler: {} submissions, {} workers'.format(len(trace), options['workers']))
+
+        for name, scheduled in [('strict', False), ('fair-share', True)]:
+            enabled = QUEUE_SCHEDULER['enabled']
+            # the simulation always uses the scheduler in the fair-share run, whatever the settings are
+            QUEUE_SCHEDULER['enabled'] = scheduled
+
+            try:
+                replayed, waits = self.simulate(rs, trace, options['workers'], scheduled)
+            finally:
+                QUEUE_SCHEDULER['enabled'] = enabled
+
+            groups = defaultdict(list)
+            flows = defaultdict(lambda: defaultdict(list))
+
+            for index, wait in waits.items():
+                record = replayed[index]
+                group = 'reevaluation' if record['flow'].startswith('invoker:') else 'task {}'.format(record['task'])
+                groups[group].append(wait)
+                flows[group][record['flow']].append(wait)
+
+            self.stdout.write(name)
+
+            for group, group_waits in sorted(groups.items()):
+                group_waits.sort()
+                # Jain's fairness index of the mean waiting times of the flows (1 = all the flows wait equally)
+                means = [statistics.mean(flow_waits) for flow_waits in flows[group].values()]
+                jain = sum(means) ** 2 / (len(means) * sum(mean ** 2 for mean in means)) if any(means) else 1
+
+                self.stdout.write('  {:<14} n {:5} | mean wait {:8.1f} s | p95 {:8.1f} s | max {:8.1f} s | '
+                                  'fairness {:.3f}'.format(group, len(group_waits), statistics.mean(group_waits),
+                                                           group_waits[int(len(group_waits) * 0.95)],
+                                                           group_waits[-1], jain))
+
+    def handle(self, *args, **options):
+        getattr(self, 'bench_{}'.format(options['target']))(options)
@@ -0,0 +1,15 @@
+from django.core.management import BaseCommand
+
+from webapp.utils.redis_facade import trim_queue_order
+
+
+class Command(BaseCommand):
+    help = "Removes stale entries from the queue order sets and checks consistency of queue positions"
+
+    def handle(self, *args, **options):
+        for priority, (removed, drift) in trim_queue_order().items():
+            self.stdout.write('queue:{}: removed {} stale order entries'.format(priority, removed))
+
+            if drift:
+                self.stderr.write('queue:{}: head differs by {} from the counter, the queue was not consumed '
+                                  'in FIFO order'.format(priority, drift))
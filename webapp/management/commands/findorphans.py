@@ -0,0 +1,34 @@
+from django.core.management import BaseCommand
+
+from webapp.models import Submission
+from webapp.utils.redis_facade import get_processing_uuids, get_worker_list, iter_queue_uuids, store_orphan_report
+
+
+class Command(BaseCommand):
+    help = "Finds submissions which are waiting for evaluation, but are neither queued nor processed by a worker. " \
+           "The result is shown on the worker status page."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of queue items read from Redis at once')
+        parser.add_argument('--limit', type=int, default=1000,
+                            help='Maximum number of orphaned UUIDs stored for the worker status page')
+
+    def handle(self, *args, **options):
+        # the database is read first, submissions created later are not taken into account
+        waiting = {str(uuid) for uuid in Submission.objects.filter(submissionevaluation__isnull=True)
+                   .values_list('uuid', flat=True).iterator()}
+        waiting_count = len(waiting)
+
+        waiting.difference_update(iter_queue_uuids(options['chunk_size']))
+        waiting.difference_update(state['current_uuid'] for name, state in get_worker_list())
+
+        # submissions could have been taken by the worker or evaluated while the queue was read
+        waiting.difference_update(get_processing_uuids(waiting, options['chunk_size']))
+        orphans = [str(uuid) for uuid in Submission.objects.filter(
+            uuid__in=waiting,
+            submissionevaluation__isnull=True
+        ).order_by('submitted').values_list('uuid', flat=True)]
+
+        store_orphan_report(orphans, waiting_count, options['limit'])
+        self.stdout.write('Found {} submissions which are not in the queue'.format(len(orphans)))
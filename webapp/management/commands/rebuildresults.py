@@ -0,0 +1,10 @@
+from django.core.management import BaseCommand
+
+from webapp.models import TaskUserResult
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the table of best and latest results of every user in every task from the evaluations"
+
+    def handle(self, *args, **options):
+        self.stdout.write('Stored {} results'.format(TaskUserResult.objects.rebuild()))
@@ -1,41 +1,76 @@
-from django.db import transaction
+from django.db import transaction, connection, close_old_connections, DatabaseError
 
-import algoweb.settings
 import logging
+import queue
 import redis
+import gzip
 import json
+import os
+import socket
+import threading
+import uuid
 
-from django.core.management import BaseCommand
+from django.core.files.base import ContentFile
+from django.core.management import BaseCommand, CommandError
+from django.utils.text import get_valid_filename
 
-from time import sleep
+from time import sleep, monotonic
 
-from webapp.models import SubmissionEvaluation, SubmissionTest, Submission
+from algoweb.settings import QUEUE_SCHEDULER, REPORTS_TRANSPORT, SUBMISSION_ADMISSION, TEST_OUTPUT_LIMITS
+from webapp.models import SubmissionEvaluation, SubmissionTest, Submission, TaskUserResult, TaskUserUsage
+from webapp.utils.redis_facade import submissions_evaluated, get_redis, get_pool_metrics, connection_pool, \
+    dispatch_scheduled, release_admissions
 
 
 class Command(BaseCommand):
     help = "Starts the Redis poller which is an essential background task for webapp"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=1, help='Number of threads storing the reports')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Maximum number of reports stored within a single transaction')
+        parser.add_argument('--buffer-size', type=int, default=1000,
+                            help='Maximum number of received reports waiting to be stored')
+        parser.add_argument('--stats-interval', type=int, default=60,
+                            help='How often (in seconds) the throughput is logged, 0 disables it')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rs = None
+        self.buffer = None
+        self.batch_size = 1
+        self.stats_interval = 0
+        self.stats_lock = threading.Lock()
+        self.stats_count = 0
+        self.stats_since = monotonic()
+        # UUIDs of reports being stored at the moment, protects against storing duplicates concurrently
+        self.in_progress = set()
+        self.in_progress_lock = threading.Lock()
+        # IDs of stream messages which are buffered or being stored by this poller
+        self.stream_in_flight = set()
+        self.stream_lock = threading.Lock()
+
     @staticmethod
     def pick_indices(dictionary, indices):
         return {k: v for (k, v) in dictionary.items() if k in indices}
 
-    def create_evaluation(self, data_text):
+    @staticmethod
+    def parse_report(data_text):
         try:
             data = json.loads(data_text.decode('utf-8'))
-        except UnicodeDecodeError:
+        except (UnicodeDecodeError, ValueError):
             logging.error('Unable to decode the data')
-            return False
+            return None
 
         try:
-            submission = Submission.objects.get(pk=data['uuid'])
-        except (ValueError, Submission.DoesNotExist):
-            logging.error("Refusing to store evaluation with invalid or nonexistent UUID: {}".format(data['uuid']))
-            return False
+            data['uuid'] = str(uuid.UUID(data['uuid']))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            logging.error("Refusing to store evaluation with invalid UUID: {}".format(data))
+            return None
 
-        if SubmissionEvaluation.objects.filter(submission__pk=data['uuid']).exists():
-            logging.error("Refusing to store evaluation for already evaluated task, UUID: {}".format(data['uuid']))
-            return False
+        return data
 
+    def build_evaluation(self, data, submission):
         eval_args = self.pick_indices(data, ['message', 'result', 'score', 'status'])
         try:
             if data['time_stats']:
@@ -45,75 +80,475 @@ class Command(BaseCommand):
         except KeyError:
             pass
 
-        with transaction.atomic():
-            evaluation = SubmissionEvaluation(submission=submission, is_invalid=False, **eval_args)
-            evaluation.save()
+        return SubmissionEvaluation(submission=submission, is_invalid=False, **eval_args)
 
-            test_outputs = self.get_test_outputs(data['uuid'])
+    def build_tests(self, data, evaluation, test_outputs, full_outputs):
+        """
+        :param full_outputs: list which receives (test, content) pairs, the full outputs are written
+        by store_full_outputs once the tests are committed
+        """
+        tests = []
 
-            for test_obj in data['tests']:
-                test_args = self.pick_indices(test_obj, ['name', 'status', 'time', 'memory', 'points', 'max_points'])
+        for test_obj in data['tests']:
+            test_args = self.pick_indices(test_obj, ['name', 'status', 'time', 'memory', 'points', 'max_points'])
 
-                if 'points' not in test_args or test_args['points'] is None:
-                    test_args['points'] = 0
+            if 'points' not in test_args or test_args['points'] is None:
+                test_args['points'] = 0
 
-                if 'max_points' not in test_args or test_args['max_points'] is None:
-                    test_args['max_points'] = 0
+            if 'max_points' not in test_args or test_args['max_points'] is None:
+                test_args['max_points'] = 0
 
-                try:
-                    test_output = test_outputs[test_args['name']]
-                    test_args['output'] = test_output['test_output']
-                    test_args['output_visibility'] = test_output['test_output_visibility']
-                except KeyError:
-                    logging.info("There is no output to store for test '{}'".format(test_args['name']))
+            test_output = {}
+
+            try:
+                test_output = test_outputs[test_args['name']]
+                test_args['output'] = test_output['test_output']
+                test_args['output_size'] = test_output['test_output_size']
+                test_args['output_visibility'] = test_output['test_output_visibility']
+            except KeyError:
+                logging.info("There is no output to store for test '{}'".format(test_args['name']))
+
+            test = SubmissionTest(evaluation=evaluation, **test_args)
 
-                test = SubmissionTest(evaluation=evaluation, **test_args)
-                test.save()
+            if 'test_output_full' in test_output:
+                filename = get_valid_filename('{}.txt.gz'.format(test.name))
+                test.full_output.name = test.full_output.field.generate_filename(test, filename)
+                full_outputs.append((test, test_output['test_output_full']))
 
-        logging.info("Saved evaluation for UUID: {}".format(data['uuid']))
-        return True
+            tests.append(test)
+
+        return tests
 
     @staticmethod
-    def get_test_outputs(submission_uuid):
-        rs = redis.Redis(**algoweb.settings.REDIS_CONFIG)
-        result = rs.hgetall("evaluation:{}".format(submission_uuid))
-        test_outputs = {}
+    def store_full_outputs(full_outputs):
+        """
+        Writes the full outputs of committed tests, so a rolled back batch does not leave files behind
+        """
+        for test, content in full_outputs:
+            reserved = test.full_output.name
+
+            try:
+                name = test.full_output.storage.save(reserved, ContentFile(content))
+            except OSError:
+                logging.exception("Unable to store the full output of test '{}'".format(test.name))
+                name = None
+
+            # the storage picks another name if the reserved one is taken (e.g. by the previous evaluation)
+            if name != reserved:
+                SubmissionTest.objects.filter(evaluation_id=test.evaluation_id, name=test.name) \
+                    .update(full_output=name)
+
+    def store_reports(self, reports):
+        """
+        Stores a batch of reports using a constant number of queries
+        :return: number of stored evaluations
+        """
+        reports = {data['uuid']: data for data in reports}
+
+        submissions = {
+            str(pk): obj for pk, obj in Submission.objects.select_related('task').in_bulk(list(reports)).items()
+        }
+        evaluated = {
+            str(sid) for sid in
+            SubmissionEvaluation.objects.filter(submission_id__in=list(reports)).values_list('submission_id', flat=True)
+        }
+
+        accepted = []
+
+        for sid, data in reports.items():
+            if sid not in submissions:
+                logging.error("Refusing to store evaluation with nonexistent UUID: {}".format(sid))
+            elif sid in evaluated:
+                logging.error("Refusing to store evaluation for already evaluated task, UUID: {}".format(sid))
+            else:
+                accepted.append(data)
+
+        if not accepted:
+            return 0
+
+        test_outputs = self.get_test_outputs([data['uuid'] for data in accepted])
+
+        with transaction.atomic():
+            evaluations = [self.build_evaluation(data, submissions[data['uuid']]) for data in accepted]
+
+            if connection.features.can_return_ids_from_bulk_insert:
+                SubmissionEvaluation.objects.bulk_create(evaluations)
+            else:
+                for evaluation in evaluations:
+                    evaluation.save()
+
+            tests = []
+            full_outputs = []
+
+            for data, evaluation in zip(accepted, evaluations):
+                tests.extend(self.build_tests(data, evaluation, test_outputs[data['uuid']], full_outputs))
+
+            SubmissionTest.objects.bulk_create(tests)
+            transaction.on_commit(lambda: self.store_full_outputs(full_outputs))
+            TaskUserResult.objects.refresh(
+                (submissions[data['uuid']].task_id, submissions[data['uuid']].user_id) for data in accepted)
+            TaskUserUsage.objects.refresh(
+                (evaluation.submission.task_id, evaluation.submission.user_id) for evaluation in evaluations
+                if evaluation.status == 'internal_error' and not evaluation.submission.reevaluated)
+
+        for data in accepted:
+            logging.info("Saved evaluation for UUID: {}".format(data['uuid']))
+
         try:
-            for k, v in result.items():
-                k = k.decode('utf-8').split(':')
-                v = v.decode('utf-8')
-                if k[0] in ['test_output', 'test_output_visibility']:
-                    try:
-                        test_outputs[k[1]][k[0]] = v
-                    except KeyError:
-                        # in this case we don't have test_outputs[k[1]] initialized
-                        test_outputs[k[1]] = {}
-                        test_outputs[k[1]][k[0]] = v
-        except (KeyError, UnicodeDecodeError):
-            logging.exception("Cannot store the output")
+            submissions_evaluated(
+                [(data['uuid'], submissions[data['uuid']].queue_priority) for data in accepted], self.rs)
+        except redis.exceptions.RedisError:
+            logging.exception("Unable to notify about stored evaluations")
+
+        if SUBMISSION_ADMISSION['enabled']:
+            try:
+                release_admissions([
+                    (data['uuid'], submissions[data['uuid']].user_id, submissions[data['uuid']].task.task_group_id)
+                    for data in accepted
+                ], self.rs)
+            except redis.exceptions.RedisError:
+                logging.exception("Unable to release admissions of evaluated submissions")
+
+        return len(accepted)
+
+    def process_batch(self, reports):
+        """
+        Stores the batch, if it fails then reports are stored one by one, so a single invalid report
+        does not prevent the others from being saved
+        Redis errors are left to the caller, which retries the whole batch
+        :return: tuple with number of stored evaluations and set of UUIDs which failed due to database
+        or storage error (the others are malformed and would never be stored)
+        """
+        try:
+            return self.store_reports(reports), set()
+        except redis.exceptions.RedisError:
+            raise
+        except Exception as e:
+            if len(reports) == 1:
+                logging.exception("Unable to store evaluation for UUID: {}".format(reports[0]['uuid']))
+                return 0, {reports[0]['uuid']} if isinstance(e, (DatabaseError, OSError)) else set()
+
+            logging.warning("Unable to store batch of {} reports, storing them one by one".format(len(reports)))
+            stored, failed = 0, set()
+
+            for data in reports:
+                single_stored, single_failed = self.process_batch([data])
+                stored += single_stored
+                failed |= single_failed
+
+            return stored, failed
+
+    def get_test_outputs(self, submission_uuids):
+        """
+        Fetches test outputs of many submissions. The hashes are scanned in chunks, all the submissions
+        within a single pipeline, so a huge hash is never transferred and decoded at once
+        :return: dictionary uuid => test name => outputs
+        """
+        test_outputs = {submission_uuid: {} for submission_uuid in submission_uuids}
+        cursors = {submission_uuid: 0 for submission_uuid in submission_uuids}
+
+        while cursors:
+            pipe = self.rs.pipeline(transaction=False)
+            scanned = list(cursors)
+
+            for submission_uuid in scanned:
+                pipe.hscan("evaluation:{}".format(submission_uuid), cursors[submission_uuid],
+                           count=TEST_OUTPUT_LIMITS['scan_count'])
+
+            for submission_uuid, (cursor, result) in zip(scanned, pipe.execute()):
+                self.parse_test_outputs(result, test_outputs[submission_uuid])
+
+                if cursor:
+                    cursors[submission_uuid] = cursor
+                else:
+                    del cursors[submission_uuid]
 
         return test_outputs
 
-    def handle(self, *args, **options):
-        log_format = '[%(asctime)s][%(levelname)s] %(message)s'
-        log_datefmt = '%d/%m/%Y %H:%M:%S'
-        logging.basicConfig(level=logging.INFO, format=log_format, datefmt=log_datefmt)
+    @staticmethod
+    def limit_output(value):
+        """
+        Truncates the output to the configured size, the full one is kept gzipped if requested
+        """
+        test_output = {'test_output_size': len(value)}
 
-        logging.info('Connecting to Redis...')
-        rs = redis.Redis(**algoweb.settings.REDIS_CONFIG)
-        rsp = rs.pubsub()
+        if len(value) <= TEST_OUTPUT_LIMITS['max_size']:
+            test_output['test_output'] = value.decode('utf-8')
+            return test_output
+
+        # the cut may split a multibyte character
+        test_output['test_output'] = value[:TEST_OUTPUT_LIMITS['max_size']].decode('utf-8', 'ignore')
+
+        if TEST_OUTPUT_LIMITS['store_full']:
+            test_output['test_output_full'] = gzip.compress(value)
+
+        return test_output
+
+    def parse_test_outputs(self, result, test_outputs):
+        """
+        :param result: chunk of the evaluation hash
+        :param test_outputs: dictionary test name => outputs, updated in place
+        """
+        for k, v in result.items():
+            try:
+                k = k.decode('utf-8').split(':', 1)
+
+                if k[0] == 'test_output':
+                    test_outputs.setdefault(k[1], {}).update(self.limit_output(v))
+                elif k[0] == 'test_output_visibility':
+                    test_outputs.setdefault(k[1], {})[k[0]] = v.decode('utf-8')
+            except (IndexError, UnicodeDecodeError):
+                logging.exception("Cannot store the output")
+
+    def claim(self, reports):
+        """
+        Marks reports as being stored, skips those which are already stored by another thread
+        """
+        claimed = []
+
+        with self.in_progress_lock:
+            for data in reports:
+                if data['uuid'] in self.in_progress:
+                    logging.error("Refusing to store evaluation which is already being stored, UUID: {}"
+                                  .format(data['uuid']))
+                else:
+                    self.in_progress.add(data['uuid'])
+                    claimed.append(data)
+
+        return claimed
+
+    def release(self, reports):
+        with self.in_progress_lock:
+            for data in reports:
+                self.in_progress.discard(data['uuid'])
+
+    def record_stats(self, stored):
+        if not self.stats_interval:
+            return
+
+        with self.stats_lock:
+            self.stats_count += stored
+            elapsed = monotonic() - self.stats_since
+
+            if elapsed >= self.stats_interval:
+                logging.info("Stored {} evaluations in {:.0f} s ({:.2f} reports/s), Redis pool: {}".format(
+                    self.stats_count, elapsed, self.stats_count / elapsed, get_pool_metrics()))
+                self.stats_count = 0
+                self.stats_since = monotonic()
+
+    def store_worker(self):
+        while True:
+            batch = [self.buffer.get()]
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+
+            reports = self.claim([data for data, message_id in batch])
+            claimed = {data['uuid'] for data in reports}
+            close_old_connections()
+
+            try:
+                for attempt in range(3):
+                    try:
+                        stored, failed = self.process_batch(reports)
+                        self.record_stats(stored)
+                        break
+                    except redis.exceptions.RedisError:
+                        logging.exception("Unable to fetch test outputs, retrying in 5 seconds...")
+                        sleep(5)
+                else:
+                    logging.error("Unable to store {} reports: {}".format(len(reports), list(claimed)))
+                    failed = claimed
+            except Exception:
+                # the thread has to keep running, otherwise the listener would block on the full buffer forever
+                logging.exception("Unable to store {} reports: {}".format(len(reports), list(claimed)))
+                failed = claimed
+            finally:
+                self.release(reports)
+
+            # reports from the stream which failed to be stored stay pending, so they are delivered again later
+            message_ids = [
+                message_id for data, message_id in batch
+                if message_id is not None and data['uuid'] in claimed and data['uuid'] not in failed
+            ]
+
+            if message_ids:
+                self.acknowledge(message_ids)
+
+            # the failed ones (and the duplicates stored by another thread) are no longer in flight,
+            # so claim_pending takes them over once they are idle
+            failed_ids = [
+                message_id for data, message_id in batch
+                if message_id is not None and (data['uuid'] not in claimed or data['uuid'] in failed)
+            ]
+
+            if failed_ids:
+                with self.stream_lock:
+                    self.stream_in_flight.difference_update(failed_ids)
+
+    def acknowledge(self, message_ids):
+        try:
+            pipe = self.rs.pipeline(transaction=False)
+            pipe.xack(REPORTS_TRANSPORT['stream'], REPORTS_TRANSPORT['group'], *message_ids)
+            pipe.xdel(REPORTS_TRANSPORT['stream'], *message_ids)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            logging.exception("Unable to acknowledge reports, they will be delivered again")
+
+        with self.stream_lock:
+            self.stream_in_flight.difference_update(message_ids)
+
+    def receive_stream_message(self, message_id, fields):
+        data = self.parse_report(fields.get(b'data', b''))
+
+        if data is None:
+            # the message is invalid and will never be stored
+            self.acknowledge([message_id])
+            return
+
+        with self.stream_lock:
+            self.stream_in_flight.add(message_id)
+
+        # blocks when the storing threads are not keeping up
+        self.buffer.put((data, message_id))
+
+    def claim_pending(self, consumer):
+        """
+        Takes over reports which were delivered, but not acknowledged within the idle time
+        (e.g. the poller which received them has crashed or was unable to store them)
+        """
+        stream, group = REPORTS_TRANSPORT['stream'], REPORTS_TRANSPORT['group']
+        idle = REPORTS_TRANSPORT['claim_idle']
+        message_ids = []
+
+        with self.stream_lock:
+            in_flight = set(self.stream_in_flight)
+
+        for entry in self.rs.xpending_range(stream, group, '-', '+', 1000):
+            message_id = entry['message_id']
+
+            if entry['time_since_delivered'] < idle or message_id in in_flight:
+                continue
+
+            if entry['times_delivered'] >= REPORTS_TRANSPORT['max_deliveries']:
+                logging.error("Dropping report {} delivered {} times".format(message_id, entry['times_delivered']))
+                self.acknowledge([message_id])
+                continue
+
+            message_ids.append(message_id)
+
+        if not message_ids:
+            return
+
+        logging.warning("Claiming {} pending reports".format(len(message_ids)))
+
+        for message_id, fields in self.rs.xclaim(stream, group, consumer, idle, message_ids):
+            if fields is not None:
+                self.receive_stream_message(message_id, fields)
+
+    def listen_stream(self):
+        stream, group = REPORTS_TRANSPORT['stream'], REPORTS_TRANSPORT['group']
+        consumer = '{}-{}'.format(socket.gethostname(), os.getpid())
+
+        while True:
+            try:
+                try:
+                    self.rs.xgroup_create(stream, group, id='0', mkstream=True)
+                except redis.exceptions.ResponseError as e:
+                    # the group already exists
+                    if 'BUSYGROUP' not in str(e):
+                        raise
+
+                logging.info("Reading reports from stream {} as {} (group {}).".format(stream, consumer, group))
+                last_claim = 0
+
+                while True:
+                    if monotonic() - last_claim >= REPORTS_TRANSPORT['claim_idle'] / 1000:
+                        self.claim_pending(consumer)
+                        last_claim = monotonic()
+
+                    response = self.rs.xreadgroup(group, consumer, {stream: '>'}, count=self.batch_size, block=5000)
+
+                    for stream_name, messages in response or []:
+                        for message_id, fields in messages:
+                            self.receive_stream_message(message_id, fields)
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                logging.error("Redis connection failed, retrying in 5 seconds...")
+                sleep(5)
+
+    def listen_pubsub(self):
+        rsp = self.rs.pubsub()
 
         while True:
             try:
                 rsp.subscribe('reports')
-                for item in rsp.listen():
+
+                while True:
+                    # waiting with a timeout (instead of listen()) lets the connection health to be checked
+                    item = rsp.get_message(timeout=1.0)
+
+                    if item is None:
+                        continue
+
                     if item['type'] == 'message':
-                        self.create_evaluation(item['data'])
+                        data = self.parse_report(item['data'])
+                        if data is not None:
+                            # blocks when the storing threads are not keeping up
+                            self.buffer.put((data, None))
                     elif item['type'] == 'subscribe' and item['data'] == 1:
                         logging.info("Successfully subscribed to: {}.".format(item['channel'].decode('utf-8')))
                         logging.info("Ready to accept submission evaluations.")
                     else:
                         logging.error("Unknown message: {}".format(item))
-            except redis.exceptions.ConnectionError:
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
                 logging.error("Redis connection failed, retrying in 5 seconds...")
                 sleep(5)
+
+    def dispatch_worker(self):
+        """
+        Keeps the worker lists filled from the scheduler, see QUEUE_SCHEDULER
+        """
+        while True:
+            try:
+                dispatch_scheduled(self.rs)
+            except redis.exceptions.RedisError:
+                logging.exception('Unable to dispatch scheduled submissions')
+                sleep(1)
+
+            sleep(QUEUE_SCHEDULER['interval'])
+
+    def handle(self, *args, **options):
+        log_format = '[%(asctime)s][%(levelname)s][%(threadName)s] %(message)s'
+        log_datefmt = '%d/%m/%Y %H:%M:%S'
+        logging.basicConfig(level=logging.INFO, format=log_format, datefmt=log_datefmt)
+
+        self.batch_size = max(1, options['batch_size'])
+        self.stats_interval = options['stats_interval']
+        self.buffer = queue.Queue(maxsize=options['buffer_size'])
+
+        # the pool is shared by the listeners (each holds a connection), all the storing threads and the dispatcher
+        connection_pool.resize(max(1, options['threads']) + 3)
+        self.rs = get_redis()
+
+        for i in range(max(1, options['threads'])):
+            threading.Thread(target=self.store_worker, name='store-{}'.format(i), daemon=True).start()
+
+        if QUEUE_SCHEDULER['enabled']:
+            threading.Thread(target=self.dispatch_worker, name='dispatch', daemon=True).start()
+
+        mode = REPORTS_TRANSPORT['mode']
+
+        if mode not in ['pubsub', 'stream', 'both']:
+            raise CommandError('Invalid REPORTS_TRANSPORT mode: {}'.format(mode))
+
+        if mode == 'both':
+            # during the migration reports may arrive both ways
+            threading.Thread(target=self.listen_stream, name='stream', daemon=True).start()
+            self.listen_pubsub()
+        elif mode == 'stream':
+            self.listen_stream()
+        else:
+            self.listen_pubsub()
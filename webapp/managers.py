@@ -1,5 +1,14 @@
-from django.db import models
-from django.db.models import Q
+import hashlib
+
+from django.core.cache import cache
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import Q, F
+
+from algoweb.settings import ROLE_CACHE_TIMEOUT
+
+
+def get_roles_cache_key(user_id):
+    return 'task_group_roles:{}'.format(user_id)
 
 
 class TaskGroupAccessManager(models.Manager):
@@ -25,3 +34,348 @@ class TaskGroupAccessManager(models.Manager):
             access.save()
 
         return access
+
+    def get_user_roles(self, user):
+        """
+        Gets roles of the user in all the task groups using a single query. Relies on accesses being bound
+        to the user (see bind_user). The result is kept within the user object for the rest of the request
+        and in the cache for ROLE_CACHE_TIMEOUT seconds if enabled
+        :return: dictionary task group id => role
+        """
+        try:
+            return user._task_group_roles
+        except AttributeError:
+            pass
+
+        roles = cache.get(get_roles_cache_key(user.id)) if ROLE_CACHE_TIMEOUT else None
+
+        if roles is None:
+            roles = dict(self.filter(user=user).values_list('task_group_id', 'role'))
+
+            if ROLE_CACHE_TIMEOUT:
+                cache.set(get_roles_cache_key(user.id), roles, ROLE_CACHE_TIMEOUT)
+
+        user._task_group_roles = roles
+        return roles
+
+    def bind_user(self, user):
+        """
+        Binds accesses granted by provider_id to the user and fills provider_id in the accesses granted
+        directly to the user, should be called when the user logs in
+        """
+        from webapp.models import CASUserMeta, CASExtIDNotAvailable
+        try:
+            provider_id = user.casusermeta.ext_id
+        except (CASUserMeta.DoesNotExist, CASExtIDNotAvailable):
+            return
+
+        # groups in which the user already has an access of the other kind are skipped (unique constraints)
+        self.filter(user=user, provider_id=None).exclude(
+            task_group__in=self.filter(provider_id=provider_id).values('task_group')
+        ).update(provider_id=provider_id)
+
+        self.filter(provider_id=provider_id).exclude(user=user).exclude(
+            task_group__in=self.filter(user=user).values('task_group')
+        ).update(user=user)
+
+        cache.delete(get_roles_cache_key(user.id))
+
+    def bind_pending(self, user):
+        """
+        Binds accesses granted by provider_id after the user has logged in, so they are visible without
+        logging in again. Done at most once per request, when the user has no role in some task group
+        :return: True if accesses were bound and the roles have to be fetched again
+        """
+        from webapp.models import CASUserMeta, CASExtIDNotAvailable
+
+        if getattr(user, '_task_group_roles_bound', False):
+            return False
+
+        user._task_group_roles_bound = True
+
+        try:
+            provider_id = user.casusermeta.ext_id
+        except (CASUserMeta.DoesNotExist, CASExtIDNotAvailable):
+            return False
+
+        if not self.filter(provider_id=provider_id).exclude(user=user).exists():
+            return False
+
+        self.bind_user(user)
+
+        if hasattr(user, '_task_group_roles'):
+            del user._task_group_roles
+
+        return True
+
+
+class TaskUserResultManager(models.Manager):
+
+    def refresh(self, pairs, create=True):
+        """
+        Recomputes best and latest valid evaluation of the given users in the given tasks,
+        should be called whenever an evaluation is stored, invalidated or removed.
+        The users are locked before the evaluations are read, so concurrent refreshes of the same user
+        (e.g. storing threads of the poller) are serialized and cannot leave the results stale
+        :param pairs: iterable of (task_id, user_id) tuples
+        :param create: whether the missing results are created, False when evaluations are removed, because
+        the task or the user may be being deleted (their results are already gone)
+        """
+        from django.contrib.auth.models import User
+        from webapp.models import SubmissionEvaluation
+
+        pairs = set(pairs)
+
+        if not pairs:
+            return
+
+        cond = Q()
+        result_cond = Q()
+
+        for task_id, user_id in pairs:
+            cond |= Q(submission__task_id=task_id, submission__user_id=user_id)
+            result_cond |= Q(task_id=task_id, user_id=user_id)
+
+        with transaction.atomic():
+            # always in the same order, so two refreshes cannot deadlock
+            list(User.objects.select_for_update().filter(
+                pk__in={user_id for task_id, user_id in pairs}).order_by('pk').values_list('pk', flat=True))
+
+            evaluations = SubmissionEvaluation.objects.filter(cond, is_invalid=False).values_list(
+                'id', 'submission__task_id', 'submission__user_id', 'score', 'submission__submitted')
+
+            best = {}
+            latest = {}
+
+            for evaluation_id, task_id, user_id, score, submitted in evaluations:
+                key = task_id, user_id
+                # the highest score (evaluations without score are the worst), then the latest one
+                rank = score is not None, score or 0, submitted
+
+                if key not in best or rank > best[key][0]:
+                    best[key] = rank, evaluation_id
+
+                if key not in latest or submitted > latest[key][0]:
+                    latest[key] = submitted, evaluation_id
+
+            existing = {(result.task_id, result.user_id): result for result in self.filter(result_cond)}
+            created = []
+
+            for key in pairs:
+                best_id = best[key][1] if key in best else None
+                latest_id = latest[key][1] if key in latest else None
+                result = existing.get(key)
+
+                if result is None:
+                    if create and latest_id is not None:
+                        created.append(self.model(task_id=key[0], user_id=key[1], best_id=best_id, latest_id=latest_id))
+                elif latest_id is None:
+                    result.delete()
+                elif result.best_id != best_id or result.latest_id != latest_id:
+                    result.best_id = best_id
+                    result.latest_id = latest_id
+                    result.save(update_fields=['best', 'latest'])
+
+            self.bulk_create(created)
+
+    def rebuild(self):
+        """
+        Recomputes the whole table from scratch
+        :return: number of stored results
+        """
+        from webapp.models import SubmissionEvaluation
+
+        def first_per_user(*ordering):
+            return dict(
+                ((task_id, user_id), evaluation_id) for task_id, user_id, evaluation_id in
+                SubmissionEvaluation.objects.filter(is_invalid=False).order_by(
+                    'submission__task_id', 'submission__user_id', *ordering
+                ).distinct(
+                    'submission__task_id', 'submission__user_id'
+                ).values_list('submission__task_id', 'submission__user_id', 'id')
+            )
+
+        best = first_per_user(F('score').desc(nulls_last=True), '-submission__submitted')
+        latest = first_per_user('-submission__submitted')
+
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create((
+                self.model(task_id=key[0], user_id=key[1], best_id=best[key], latest_id=latest_id)
+                for key, latest_id in latest.items()
+            ), batch_size=1000)
+
+        return len(latest)
+
+
+class SubmissionFileManager(models.Manager):
+
+    def create_from_upload(self, submission, file):
+        """
+        Stores the uploaded file as a blob named after the digest of its contents, so identical files
+        (resubmissions, re-evaluations) share a single blob which is written only once
+        :param file: UploadedFile object
+        """
+        digest = hashlib.sha256()
+
+        for chunk in file.chunks():
+            digest.update(chunk)
+
+        submission_file = self.model(submission=submission, name=file.name, digest=digest.hexdigest())
+        contents = submission_file.contents
+        blob_name = contents.field.generate_filename(submission_file, file.name)
+
+        with transaction.atomic():
+            # the existing blob cannot be deleted until the row pointing to it is committed
+            self.lock_blob(submission_file.digest)
+
+            if contents.storage.exists(blob_name):
+                contents.name = blob_name
+            else:
+                contents.save(file.name, file, save=False)
+
+            submission_file.save()
+
+        return submission_file
+
+    def is_referenced(self, name):
+        """
+        Reference count of a stored file is the number of rows pointing to it
+        """
+        return self.filter(contents=name).exists()
+
+    def delete_unreferenced(self, name, digest):
+        """
+        Deletes the stored file if there is no row pointing to it, should be called once the deletion
+        of the row is committed
+        """
+        storage = self.model._meta.get_field('contents').storage
+
+        with transaction.atomic():
+            if digest:
+                self.lock_blob(digest)
+
+            if not self.is_referenced(name):
+                storage.delete(name)
+
+    @staticmethod
+    def lock_blob(digest):
+        """
+        Serializes storing and deleting of the blob, the lock is held until the end of the transaction.
+        Uses a PostgreSQL advisory lock, blobs are not locked on the other database backends
+        """
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [int(digest[:15], 16)])
+
+
+class SubmissionEvaluationManager(models.Manager):
+
+    def reuse(self, submission):
+        """
+        Copies the latest evaluation of an identical submission (same files and task version) of the same user,
+        so the submission does not have to be evaluated again. Evaluations which failed because of the worker
+        or were invalidated by the staff are not reused.
+        :return: new SubmissionEvaluation object or None if there is nothing to reuse
+        """
+        from webapp.models import SubmissionTest
+
+        if not submission.digest:
+            return None
+
+        evaluation = self.filter(
+            submission__digest=submission.digest,
+            submission__task_id=submission.task_id,
+            submission__user_id=submission.user_id,
+            is_invalid=False
+        ).exclude(
+            submission_id=submission.pk
+        ).exclude(
+            status='internal_error'
+        ).order_by('-received').first()
+
+        if evaluation is None:
+            return None
+
+        tests = list(evaluation.submissiontest_set.all())
+
+        with transaction.atomic():
+            submission.reused_from_id = evaluation.submission_id
+            submission.save(update_fields=['digest', 'reused_from'])
+
+            evaluation.pk = None
+            evaluation.submission = submission
+            evaluation.save()
+
+            for test in tests:
+                test.pk = None
+                test.evaluation = evaluation
+
+            SubmissionTest.objects.bulk_create(tests)
+
+        return evaluation
+
+
+class TaskUserUsageManager(models.Manager):
+
+    def count_used(self, task_id, user_id):
+        from webapp.models import Submission
+
+        condition = Q(task_id=task_id) & Q(user_id=user_id) & \
+            ~Q(submissionevaluation__status='internal_error') & Q(reevaluated=False)
+
+        return Submission.objects.filter(condition).count()
+
+    def lock(self, task_id, user_id):
+        """
+        Gets the counter locked until the end of the transaction,
+        the missing one (e.g. for submissions sent before the counters were introduced) is counted
+        """
+        try:
+            return self.select_for_update().get(task_id=task_id, user_id=user_id)
+        except self.model.DoesNotExist:
+            pass
+
+        try:
+            with transaction.atomic():
+                return self.create(task_id=task_id, user_id=user_id, used=self.count_used(task_id, user_id))
+        except IntegrityError:
+            # created by a concurrent transaction in the meantime
+            return self.select_for_update().get(task_id=task_id, user_id=user_id)
+
+    def get_used(self, task_id, user_id):
+        try:
+            return self.get(task_id=task_id, user_id=user_id).used
+        except self.model.DoesNotExist:
+            with transaction.atomic():
+                return self.lock(task_id, user_id).used
+
+    def increment(self, task_id, user_id):
+        """
+        Should be called after the submission is created, within the transaction holding the lock
+        """
+        self.filter(task_id=task_id, user_id=user_id).update(used=F('used') + 1)
+
+    def refresh(self, pairs):
+        """
+        Recounts the submissions of the given users in the given tasks, should be called whenever
+        a submission is removed or an evaluation changes whether it counts (worker failure)
+        :param pairs: iterable of (task_id, user_id) tuples
+        """
+        for task_id, user_id in set(pairs):
+            with transaction.atomic():
+                usage = self.lock(task_id, user_id)
+                usage.used = self.count_used(task_id, user_id)
+                usage.save(update_fields=['used'])
+
+    def recount(self, pairs):
+        """
+        Like refresh, but only the existing counters are recounted and the missing ones are never created,
+        so it can be called while the task or the user is being deleted (their counters are already gone)
+        :param pairs: iterable of (task_id, user_id) tuples
+        """
+        for task_id, user_id in set(pairs):
+            with transaction.atomic():
+                for usage in self.select_for_update().filter(task_id=task_id, user_id=user_id):
+                    usage.used = self.count_used(task_id, user_id)
+                    usage.save(update_fields=['used'])
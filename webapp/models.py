@@ -8,7 +8,6 @@ from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import PermissionDenied
 from django.db import models
-from django.db.models import Q
 from django.utils.timezone import utc
 from django.utils.safestring import mark_safe
 
@@ -22,6 +21,8 @@ class TaskGroup(models.Model):
     is_public = models.BooleanField(default=False)
     description = models.TextField(blank=True, null=True)
     archived = models.BooleanField(default=False, editable=False)
+    # overrides SUBMISSION_ADMISSION['max_in_flight']['group'] if set
+    max_in_flight = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
         ordering = ['name']
@@ -29,14 +30,18 @@ class TaskGroup(models.Model):
     def check_membership(self, user):
         """
         get string describing membership.
-        updates TaskGroupAccess object in case of missing app-given user_id
+        roles of the user in all the groups are fetched at once, see TaskGroupAccessManager.get_user_roles
         :return: string with membership
         :except: raises PermissionDenied in case of no membership
         """
+        roles = TaskGroupAccess.objects.get_user_roles(user)
+
+        if self.id not in roles and TaskGroupAccess.objects.bind_pending(user):
+            roles = TaskGroupAccess.objects.get_user_roles(user)
 
         try:
-            access = self.taskgroupaccess_set.get_user_access(user, self)
-        except TaskGroupAccess.DoesNotExist:
+            return roles[self.id]
+        except KeyError:
             if user.is_superuser:
                 access = TaskGroupAccess(
                     user=user,
@@ -44,6 +49,7 @@ class TaskGroup(models.Model):
                     task_group=self
                 )
                 access.save()
+                roles[self.id] = 'dev'
                 return 'dev'
             else:
                 if self.is_public:
@@ -51,8 +57,6 @@ class TaskGroup(models.Model):
                 else:
                     raise PermissionDenied
 
-        return access.role
-
     def __str__(self):
         return 'Task group {} '.format(self.name)
 
@@ -155,6 +159,8 @@ class Task(models.Model):
 
     # decides whether to show best or latest result in staff panel
     result_type = models.CharField(default='best', max_length=12, choices=RESULT_TYPE)
+    # identical resubmissions (same files, same task version) get the previous evaluation instead of a worker run
+    reuse_evaluations = models.BooleanField(default=False)
 
     # -- LIMITS --
     # limit of submissions for a single user
@@ -185,18 +191,21 @@ class Task(models.Model):
         else:
             return None
 
-    def get_user_limits(self, user_id):
+    def get_user_limits(self, user_id, lock=False):
         """
         get dictionary describing limit usage for particular user
 
+        :param lock: lock the usage counter until the end of the transaction, so the limit cannot be
+        exceeded by concurrent submissions (has to be called within transaction.atomic)
         :return: dict with keys 'total', 'used' and 'remaining'
         :Note: 'remaining' and 'total' may be None - this means no limit
         """
-        condition = Q(task_id=self.id) & Q(user_id=user_id) & \
-            ~Q(submissionevaluation__status='internal_error') & Q(reevaluated=False)
+        if lock:
+            used = TaskUserUsage.objects.lock(self.id, user_id).used
+        else:
+            used = TaskUserUsage.objects.get_used(self.id, user_id)
 
-        limit = Task.objects.get(pk=self.id).submission_limit
-        used = Submission.objects.filter(condition).count()
+        limit = self.submission_limit
 
         if limit > 0:
             return self.USER_LIMITS(total=limit, used=used, remaining=limit-used, can_submit=limit-used > 0)
@@ -248,6 +257,11 @@ class Submission(models.Model):
     copy_of = models.ForeignKey('self', on_delete=models.SET_NULL, blank=True, null=True)
     invoked_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='invoker')
 
+    # digest of the submitted files and the task version, see get_submission_digest
+    digest = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    # submission whose evaluation was reused, see Task.reuse_evaluations
+    reused_from = models.ForeignKey('self', on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+
     class Meta:
         ordering = ['submitted']
 
@@ -256,19 +270,32 @@ class Submission(models.Model):
 
 
 def get_submission_filename(self, filename):
+    if self.digest:
+        # content-addressed blob shared by all the submission files with the same contents
+        return path_join('submission', 'blob', self.digest[:2], self.digest)
+
     return path_join('submission', str(self.submission.uuid), filename)
 
 
 class SubmissionFile(models.Model):
+    from webapp.managers import SubmissionFileManager
+    objects = SubmissionFileManager()
+
     submission = models.ForeignKey(Submission, on_delete=models.CASCADE)
     name = models.CharField(max_length=64)
-    contents = models.FileField(upload_to=get_submission_filename)
+    # blobs are shared, so the rows pointing to the file are looked up when a row is deleted
+    contents = models.FileField(upload_to=get_submission_filename, db_index=True)
+    # SHA-256 of the contents, files stored before it was introduced do not have it
+    digest = models.CharField(max_length=64, blank=True, null=True, db_index=True)
 
     def __str__(self):
         return self.name
 
 
 class SubmissionEvaluation(models.Model):
+    from webapp.managers import SubmissionEvaluationManager
+    objects = SubmissionEvaluationManager()
+
     submission = models.ForeignKey(Submission, on_delete=models.CASCADE)
     received = models.DateTimeField(auto_now_add=True)
     message = models.TextField(null=True)
@@ -336,6 +363,47 @@ class SubmissionEvaluation(models.Model):
         return result
 
 
+class TaskUserResult(models.Model):
+    """
+    Best and latest valid evaluation of the user in the task, kept up to date by TaskUserResultManager.refresh
+    """
+    from webapp.managers import TaskUserResultManager
+    objects = TaskUserResultManager()
+    task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    best = models.ForeignKey(SubmissionEvaluation, on_delete=models.SET_NULL, null=True, related_name='+')
+    latest = models.ForeignKey(SubmissionEvaluation, on_delete=models.SET_NULL, null=True, related_name='+')
+
+    class Meta:
+        unique_together = (('task', 'user'),)
+
+    def __str__(self):
+        return 'results of user #{} in task #{}: best {}, latest {}'.format(
+            self.user_id, self.task_id, self.best_id, self.latest_id)
+
+
+class TaskUserUsage(models.Model):
+    """
+    Number of submissions of the user in the task counted towards the submission limit (the re-evaluated
+    ones and the ones which failed because of the worker are not), kept up to date by TaskUserUsageManager
+    """
+    from webapp.managers import TaskUserUsageManager
+    objects = TaskUserUsageManager()
+    task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    used = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('task', 'user'),)
+
+    def __str__(self):
+        return 'usage of user #{} in task #{}: {}'.format(self.user_id, self.task_id, self.used)
+
+
+def get_test_output_filename(self, filename):
+    return path_join('output', str(self.evaluation.submission_id), filename)
+
+
 class SubmissionTest(models.Model):
     evaluation = models.ForeignKey(SubmissionEvaluation, on_delete=models.CASCADE)
     name = models.CharField(max_length=32)
@@ -347,6 +415,10 @@ class SubmissionTest(models.Model):
     output = models.TextField(null=True)
     # options are: Null, "private" - (staff only), "public" - (staff & user)
     output_visibility = models.CharField(null=True, max_length=10)
+    # size of the original output in bytes, if it was truncated then the full one is stored gzipped in the file
+    output_size = models.IntegerField(null=True)
+    # reused evaluations share the file with the original one, so it is looked up when a test is deleted
+    full_output = models.FileField(upload_to=get_test_output_filename, null=True, db_index=True)
 
     class Meta:
         ordering = ['id']
@@ -354,6 +426,10 @@ class SubmissionTest(models.Model):
     def __str__(self):
         return '{}: {} ({} ms)'.format(self.name, self.status, self.time)
 
+    @property
+    def output_truncated(self):
+        return self.output_size is not None and len(self.output.encode('utf-8')) < self.output_size
+
     @property
     def tpl_data(self):
         if self.status == 'ok':
@@ -433,6 +509,13 @@ class SubmissionOperation(Operation):
     is_bulk = models.BooleanField(default=True)
     extra = JSONField(blank=True, null=True)
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    # progress of the background re-evaluation (number of submissions pushed to the queue)
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    finished = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    # updated with every batch, the re-evaluation is considered interrupted when it stops changing
+    heartbeat = models.DateTimeField(blank=True, null=True)
 
 
 class CASExtIDNotAvailable(RuntimeError):
@@ -1,8 +1,13 @@
-from django.db.models.signals import pre_save
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 import django_cas_ng.signals
 
-from webapp.models import TaskGroupAccess, Task, CASUserMeta
+from webapp.managers import get_roles_cache_key
+from webapp.models import TaskGroupAccess, Task, CASUserMeta, SubmissionEvaluation, TaskUserResult, SubmissionFile, \
+    Submission, TaskUserUsage, SubmissionTest
 from webapp.utils.main import apply_markdown
 from webapp.utils.template import short_name
 from algoweb.settings import CAS_KEY_FIRST_NAME, CAS_KEY_LAST_NAME, CAS_KEY_EMAIL, \
@@ -45,6 +50,78 @@ def pre_save_task_group_access(sender, instance, *args, **kwargs):
             pass
 
 
+@receiver(post_save, sender=TaskGroupAccess)
+@receiver(post_delete, sender=TaskGroupAccess)
+def invalidate_task_group_roles(sender, instance, *args, **kwargs):
+    if instance.user_id:
+        cache.delete(get_roles_cache_key(instance.user_id))
+
+
+@receiver(post_save, sender=SubmissionEvaluation)
+def refresh_task_user_result(sender, instance, *args, **kwargs):
+    # evaluations stored with bulk_create (runpoller) have to be refreshed explicitly
+    TaskUserResult.objects.refresh([(instance.submission.task_id, instance.submission.user_id)])
+
+
+@receiver(post_save, sender=SubmissionEvaluation)
+def refresh_task_user_usage(sender, instance, *args, **kwargs):
+    # submissions which failed because of the worker are not counted towards the limit
+    if instance.status == 'internal_error':
+        TaskUserUsage.objects.refresh([(instance.submission.task_id, instance.submission.user_id)])
+
+
+# the deletion may be cascaded from the task or the user, whose counters are deleted before the submissions,
+# so the counters are only recounted here, never created
+
+
+@receiver(post_delete, sender=SubmissionEvaluation)
+def refresh_task_user_result_on_delete(sender, instance, *args, **kwargs):
+    # best and latest are set to NULL by the deletion, another evaluation of the user takes their place
+    TaskUserResult.objects.refresh([(instance.submission.task_id, instance.submission.user_id)], create=False)
+
+
+@receiver(post_delete, sender=SubmissionEvaluation)
+def recount_task_user_usage(sender, instance, *args, **kwargs):
+    if instance.status == 'internal_error':
+        TaskUserUsage.objects.recount([(instance.submission.task_id, instance.submission.user_id)])
+
+
+@receiver(post_delete, sender=Submission)
+def recount_task_user_usage_on_delete(sender, instance, *args, **kwargs):
+    if not instance.reevaluated:
+        TaskUserUsage.objects.recount([(instance.task_id, instance.user_id)])
+
+
+@receiver(post_delete, sender=SubmissionFile)
+def delete_unreferenced_file(sender, instance, *args, **kwargs):
+    # stored files are shared by the submission copies and identical submissions,
+    # the file is removed when the last row pointing to it is gone
+    name = instance.contents.name
+    digest = instance.digest
+
+    if name:
+        transaction.on_commit(lambda: SubmissionFile.objects.delete_unreferenced(name, digest))
+
+
+@receiver(post_delete, sender=SubmissionTest)
+def delete_unreferenced_full_output(sender, instance, *args, **kwargs):
+    # copies of reused evaluations point to the same file
+    name = instance.full_output.name
+    storage = instance.full_output.storage
+
+    def delete_file():
+        if name and not SubmissionTest.objects.filter(full_output=name).exists():
+            storage.delete(name)
+
+    transaction.on_commit(delete_file)
+
+
+@receiver(user_logged_in)
+def bind_task_group_access(sender, user, *args, **kwargs):
+    # accesses granted by provider_id are bound to the account here, so checking them needs only user_id
+    TaskGroupAccess.objects.bind_user(user)
+
+
 @receiver(pre_save, sender=Task)
 def increment_version(instance, **kwargs):
     instance.version += 1
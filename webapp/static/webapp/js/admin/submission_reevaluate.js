@@ -9,7 +9,8 @@ if (tasks && lang) {
 
     if (total > 1) {
         $('#confirm-message').hide();
-        var int = setInterval(function () {
+        // total progress is refreshed whenever the statuses are received, so it follows the server's pace
+        tasks.onUpdate = function () {
             var current = tasks.checkList.length,
                 progress = (1 - (current / total)) * 100,
                 $barWrap = $('#total-progress-bar'),
@@ -29,8 +30,8 @@ if (tasks && lang) {
                 $barWrap.fadeOut(100, function () {
                     $('#confirm-message').html('<p class="text-center">The re-evaluation is completed</p>').fadeIn(100);
                 });
-                clearInterval(int);
+                tasks.onUpdate = function () {};
             }
-        }, 200);
+        };
     }
 }
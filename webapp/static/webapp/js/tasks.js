@@ -10,6 +10,11 @@ var tasks = {
             updateRate:  300, // .3 s
             defaultExitMessage: "Unrecognized state... Terminating."
         },
+        streamStatus: {
+            requestUrl:  "/task/submission/status/stream/",
+            // the page tells whether the server has the stream enabled (data-status-stream of the script tag)
+            enabled:     $('script[data-status-stream]').data('status-stream') === true
+        },
         // triggers console logging
         dev: false
     },
@@ -18,6 +23,10 @@ var tasks = {
     checkList: [],
     // mapping uuid -> $row
     objects: {},
+    // mapping uuid -> version of the last received status
+    versions: {},
+    // called after each batch of status updates
+    onUpdate: function () {},
 
     // initializes status check for each row with special "trigger" class specified in settings
     init: function () {
@@ -29,30 +38,70 @@ var tasks = {
         });
 
         if (tasks.checkList.length) {
-            tasks.updateStatus();
+            window.EventSource && tasks.settings.streamStatus.enabled ? tasks.streamStatus() : tasks.updateStatus();
         }
     },
 
+    // receives status updates pushed by the server, falls back to polling if the server rejects the stream
+    streamStatus: function () {
+        var query = tasks.checkList.map(function (id) {
+                return 'id=' + encodeURIComponent(id);
+            }).join('&'),
+            source = new EventSource(tasks.settings.streamStatus.requestUrl + '?' + query);
+
+        source.onmessage = function (e) {
+            var response = JSON.parse(e.data);
+            tasks.settings.dev ? console.log(response) : '';
+            tasks.parseResponse(response);
+            tasks.onUpdate();
+            if (!tasks.checkList.length) {
+                source.close();
+            }
+        };
+        // the stream has reached its maximum duration, open a new one for the remaining submissions
+        source.addEventListener('end', function () {
+            source.close();
+            if (tasks.checkList.length) {
+                tasks.streamStatus();
+            }
+        });
+        source.onerror = function () {
+            // transient failures are retried by the EventSource itself, it gives up only when the stream
+            // is rejected by the server (e.g. 404)
+            if (source.readyState !== EventSource.CLOSED) {
+                return;
+            }
+            tasks.settings.dev ? console.warn("status stream unavailable... falling back to polling") : '';
+            if (tasks.checkList.length) {
+                tasks.updateStatus();
+            }
+        };
+    },
+
     // updates the status of all submissions that are pending
+    // only statuses which differ from the already seen versions are received
     updateStatus: function () {
         $.ajax({
             url: tasks.settings.updateStatus.requestUrl,
             type: "POST",
-            data: JSON.stringify({"ids": tasks.checkList}),
+            data: JSON.stringify({"ids": tasks.checkList, "versions": tasks.versions}),
             dataType: 'json',
             contentType: 'application/json; charset=utf-8'
         }).done(function (response) {
             tasks.settings.dev ? console.log(response) : '';
-            if (response && response.length) {
-                var length = response.length;
+            if (response && response.statuses) {
+                var length = response.statuses.length;
                 for (var i = 0; i < length; i++) {
-                    tasks.parseResponse(response[i]);
+                    tasks.versions[response.statuses[i].id] = response.statuses[i].version;
+                    tasks.parseResponse(response.statuses[i]);
                 }
-                // call itself until checkList becomes empty
-                if (tasks.checkList.length) {
+                tasks.onUpdate();
+                // call itself until checkList becomes empty or there is nothing to wait for,
+                // server suggests the delay depending on the position in the queue
+                if (tasks.checkList.length && response.retry_after) {
                     setTimeout(function () {
                         tasks.updateStatus();
-                    }, tasks.settings.updateStatus.updateRate);
+                    }, Math.max(response.retry_after, tasks.settings.updateStatus.updateRate));
                 }
             }
         }).fail(function (response)
@@ -1,3 +1,87 @@
-from django.test import TestCase
+import json
+import uuid
 
-# Create your tests here.
+from unittest import mock
+
+import redis
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import SimpleTestCase, TestCase
+
+from algoweb.settings import REDIS_CONFIG
+from webapp.models import Submission, SubmissionEvaluation, Task, TaskGroup, TaskGroupAccess, TaskGroupSet
+from webapp.utils.redis_facade import enqueue_submission, get_submission_statuses, submissions_evaluated
+
+
+class TasksViewQueriesTest(TestCase):
+    # session, user, roles, groups, sets, tasks and accepted tasks
+    QUERIES = 7
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw', is_staff=True)
+        self.user = User.objects.create_user('student', 'student@example.com', 'pw')
+        self.client.login(username='student', password='pw')
+
+    def create_groups(self, group_count, set_count, task_count):
+        for i in range(group_count):
+            group = TaskGroup.objects.create(name='Group {}'.format(i))
+            TaskGroupAccess.objects.create(user=self.user, task_group=group, role='user')
+
+            for j in range(set_count):
+                tg_set = TaskGroupSet.objects.create(name='Set {}'.format(j), task_group=group)
+
+                for k in range(task_count):
+                    task = Task.objects.create(name='Task {}'.format(k), description='', owner=self.owner,
+                                               task_group=group, tg_set=tg_set, published=True, package='pkg.zip')
+                    submission = Submission.objects.create(uuid=uuid.uuid4(), user=self.user, task=task)
+                    SubmissionEvaluation.objects.create(submission=submission, status='ok', score=100)
+
+    def assert_tasks_queries(self):
+        with self.assertNumQueries(self.QUERIES):
+            response = self.client.get(reverse('tasks'))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_single_group(self):
+        self.create_groups(1, 1, 1)
+        self.assert_tasks_queries()
+
+    def test_many_groups_and_sets(self):
+        self.create_groups(8, 6, 2)
+        self.assert_tasks_queries()
+
+
+class SubmissionStatusesTest(SimpleTestCase):
+
+    def setUp(self):
+        # a database next to the configured one, so the real queue is never touched
+        config = REDIS_CONFIG.copy()
+        config['db'] = config.get('db', 0) + 1
+        self.rs = redis.Redis(**config)
+        self.rs.flushdb()
+        self.addCleanup(self.rs.flushdb)
+
+        patcher = mock.patch('webapp.utils.redis_facade.get_redis', return_value=self.rs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_status(self, sid, seq):
+        return get_submission_statuses([(sid, 'medium', seq)])[sid]
+
+    def test_taken_before_status(self):
+        sid = str(uuid.uuid4())
+        seq = enqueue_submission(self.rs, sid, 'medium', [], {'uuid': sid})
+
+        self.assertEqual(self.get_status(sid, seq), ('queued', {'position': 1}))
+
+        # the worker has taken the submission, but has not set its status yet
+        self.rs.lpop('queue:medium')
+        self.assertEqual(self.get_status(sid, seq), ('processing', {'status': 'preparing', 'progress': 0}))
+
+        self.rs.set('status:%s' % sid, json.dumps({'status': 'testing', 'progress': 50}))
+        self.assertEqual(self.get_status(sid, seq), ('processing', {'status': 'testing', 'progress': 50}))
+
+        self.rs.delete('status:%s' % sid)
+        submissions_evaluated([(sid, 'medium')], self.rs)
+        self.assertEqual(self.get_status(sid, seq), ('not-found', None))
@@ -21,7 +21,9 @@ urlpatterns = [
     url(r'^task/(?P<task_id>[0-9]+)/$', v.task, name='task'),
     url(r'^task/(?P<task_id>[0-9]+)/submit/$', v.task_submit, name='submit_task'),
     url(r'^task/submission/status/$', v.submission_status, name='check_submission_status'),
+    url(r'^task/submission/status/stream/$', v.submission_status_stream, name='stream_submission_status'),
     url(r'^task/report/(?P<submission_id>[^/]+)/$', v.submission_report, name='view_report'),
+    url(r'^task/report/output/(?P<test_id>[0-9]+)/$', v.download_test_output, name='download_test_output'),
 
     # accounts
     url(r'^accounts/login/$', v.choose_login_method, name='base_login'),
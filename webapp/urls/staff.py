@@ -62,6 +62,7 @@ urlpatterns = [
     # | - submissions
 
     url(r'^submission/(?P<submission_id>[^/]+)/report/$', submission.report, name='staff_submission_report'),
+    url(r'^submission/output/(?P<test_id>[0-9]+)/$', submission.test_output, name='staff_test_output'),
     url(r'^submission/(?P<s_uuid>[^/]+)/reevaluate/$',
         submission.perform_action, {'action': 'reevaluate'}, name='staff_submission_reevaluate'),
     url(r'^submission/(?P<s_uuid>[^/]+)/invalidate/$',
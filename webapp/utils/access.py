@@ -8,9 +8,10 @@ from django.core.mail import EmailMessage
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 
-from algoweb.settings import CSV_FIRST_NAME, CSV_LAST_NAME, CSV_EXTERNAL_ID, EMAIL_SENDER_INVITATION
+from algoweb.settings import CSV_FIRST_NAME, CSV_LAST_NAME, CSV_EXTERNAL_ID, EMAIL_SENDER_INVITATION, \
+    CAS_KEY_EXTERNAL_ID
 from webapp.forms import TaskGroupAccessForm, TaskGroupInviteForm
-from webapp.models import TaskGroup, Task, TaskGroupAccess, TaskGroupInviteToken
+from webapp.models import TaskGroup, Task, TaskGroupAccess, TaskGroupInviteToken, CASUserMeta
 from webapp.utils.template import short_name
 
 
@@ -88,6 +89,16 @@ def grant_abstract_user_access(group_id, user):
             access.role = 'user'
             access.provider_first_name = short_name(user['first_name'])
             access.provider_last_name = user['last_name']
+
+            # bind the access to the account if the user has already logged in (otherwise it is done on login)
+            user_ids = CASUserMeta.objects.filter(
+                attributes__contains={CAS_KEY_EXTERNAL_ID: user['provider_id']}
+            ).values_list('user_id', flat=True)[:1]
+
+            for user_id in user_ids:
+                if not TaskGroupAccess.objects.filter(task_group_id=group_id, user_id=user_id).exists():
+                    access.user_id = user_id
+
             access.save()
     except KeyError:
         return None
@@ -0,0 +1,86 @@
+from collections import namedtuple
+
+from django.core.cache import cache
+
+from algoweb.settings import SUBMISSION_ADMISSION
+from webapp.models import SubmissionEvaluation
+from webapp.utils.redis_facade import admit_submission, get_queue_lengths, get_worker_list
+
+ADMISSION = namedtuple('ADMISSION', ['admitted', 'deferred', 'reason', 'wait', 'depth'])
+
+THROUGHPUT_CACHE_KEY = 'admission:throughput'
+
+
+def get_throughput():
+    """
+    Estimates how many submissions are evaluated per second, from the average worker_took_time
+    of the last evaluations and the number of alive workers. The result is cached for
+    SUBMISSION_ADMISSION['eta_cache_timeout'] seconds.
+    :return: submissions per second or None if there is no estimate (no history or no workers)
+    """
+    throughput = cache.get(THROUGHPUT_CACHE_KEY)
+
+    if throughput is not None:
+        # zero is cached when there is no estimate, so it is not computed on every request
+        return throughput or None
+
+    took_times = list(SubmissionEvaluation.objects.filter(
+        worker_took_time__isnull=False
+    ).order_by('-id').values_list('worker_took_time', flat=True)[:SUBMISSION_ADMISSION['eta_sample']])
+
+    workers = len(get_worker_list())
+    throughput = 0
+
+    if took_times and workers:
+        # milliseconds to seconds, a single evaluation is counted at least for a millisecond
+        throughput = workers / max(sum(took_times) / len(took_times) / 1000, 0.001)
+
+    cache.set(THROUGHPUT_CACHE_KEY, throughput, SUBMISSION_ADMISSION['eta_cache_timeout'])
+
+    return throughput or None
+
+
+def estimate_wait(depth):
+    """
+    :param depth: number of submissions in the queue
+    :return: estimated time in seconds until the queue is processed or None if it cannot be estimated
+    """
+    throughput = get_throughput()
+
+    if throughput is None:
+        return None
+
+    return int(depth / throughput)
+
+
+def get_queue_state():
+    """
+    :return: dictionary with the queue depth and the estimated wait (seconds, may be None)
+    """
+    depth = sum(get_queue_lengths().values())
+
+    return {'depth': depth, 'wait': estimate_wait(depth) if depth else 0}
+
+
+def check_admission(uuid, user_id, task_group):
+    """
+    Decides whether the submission may enter the queue, see SUBMISSION_ADMISSION. The admitted submission
+    is counted as in flight until release_admissions is called for it.
+    :param task_group: TaskGroup object of the task, its max_in_flight overrides the group limit
+    :return: ADMISSION tuple, deferred submissions are admitted with the low priority
+    """
+    if not SUBMISSION_ADMISSION['enabled']:
+        return ADMISSION(True, False, None, None, None)
+
+    verdict, retry_after, depth = admit_submission(uuid, user_id, task_group.id, task_group.max_in_flight)
+
+    if verdict == 'rate':
+        return ADMISSION(False, False, verdict, retry_after, depth)
+
+    if verdict != 'ok':
+        return ADMISSION(False, False, verdict, estimate_wait(depth), depth)
+
+    if depth >= SUBMISSION_ADMISSION['defer_depth']:
+        return ADMISSION(True, True, None, estimate_wait(depth), depth)
+
+    return ADMISSION(True, False, None, None, depth)
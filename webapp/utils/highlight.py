@@ -1,11 +1,23 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import caches
+from django.core.files.storage import default_storage
 from pygments import highlight
 from pygments.formatters.html import HtmlFormatter
 from pygments.lexers import get_lexer_for_filename
 from pygments.util import ClassNotFound
 
+from algoweb.settings import HIGHLIGHT_PRERENDER_WORKERS
+
+# has to be increased whenever the generated HTML changes, so the cached highlights are not used anymore
+FORMATTER_VERSION = 2
+
 
 class ListHtmlFormatter(HtmlFormatter):
-    def wrap(self, source, outfile):
+    def wrap(self, source, outfile=None):
+        # outfile is not passed by Pygments 2.12+
         return self._wrap_div(
             self._wrap_pre(
                     self._wrap_lines(source)
@@ -14,39 +26,92 @@ class ListHtmlFormatter(HtmlFormatter):
 
     @staticmethod
     def _wrap_lines(source):
-        ln = ''
-        lc = ''
+        ln = []
+        lc = []
         n = 0
 
         for i, line in source:
             if i == 1:
                 n += 1
                 f = ' first' if n == 1 else ''
-                ln += '<div class="l-num{}" data-n="{}">{}</div>'.format(f, n, n)
-                lc += '<div class="l-code{}" data-n="{}">{}</div>'.format(f, n, line)
+                ln.append('<div class="l-num{}" data-n="{}">{}</div>'.format(f, n, n))
+                lc.append('<div class="l-code{}" data-n="{}">{}</div>'.format(f, n, line))
+
+        yield 0, '<table><tr><td class="lines-gutter">{}</td><td class="code-content">{}</td></tr></table>'.format(
+            ''.join(ln), ''.join(lc))
+
+
+def get_highlight_cache_key(file_id):
+    return 'highlight:{}:{}'.format(FORMATTER_VERSION, file_id)
+
+
+def highlight_file(name, contents, formatter=None):
+    """
+    :param name: name of the file, the language is guessed from it
+    :param contents: contents of the file as bytes
+    :return: dictionary with the language name and HTML formatted highlight or None if it is not supported
+    """
+    try:
+        lexer = get_lexer_for_filename(name)
+    except ClassNotFound:
+        return None
+
+    return {
+        "lang": lexer.name,
+        "html": highlight(contents.decode('utf-8', 'replace'), lexer, formatter or ListHtmlFormatter())
+    }
+
 
-        yield 0, '<table><tr><td class="lines-gutter">{}</td><td class="code-content">{}</td></tr></table>'.format(ln,
-                                                                                                                   lc)
+prerender_executor = None
+
+
+def prerender_file(file_id, name, path):
+    try:
+        with default_storage.open(path, 'rb') as file:
+            result = highlight_file(name, file.read())
+
+        caches['highlight'].set(get_highlight_cache_key(file_id), result or {})
+    except Exception:
+        logging.exception('Unable to highlight submission file #{}'.format(file_id))
+
+
+def prerender_submission_files(files):
+    """
+    Highlights the files in the background threads, so the first view of the report does not have to wait
+    :param files: list of SubmissionFile objects which are already saved
+    """
+    global prerender_executor
+
+    if not HIGHLIGHT_PRERENDER_WORKERS:
+        return
+
+    if prerender_executor is None:
+        prerender_executor = ThreadPoolExecutor(HIGHLIGHT_PRERENDER_WORKERS, thread_name_prefix='highlight')
+
+    for fl in files:
+        prerender_executor.submit(prerender_file, fl.id, fl.name, fl.contents.name)
 
 
 def highlight_submission_files(files):
     """
     Gets the list of SubmissionFile objects and returns
-    id-indexed dictionary of their HTML formatted highlights
+    id-indexed dictionary of their HTML formatted highlights.
+    Submission files never change, so the highlights are cached (usually already
+    at submission time, see prerender_submission_files), missing ones are rendered on demand
     """
+    cache = caches['highlight']
     formatter = ListHtmlFormatter()
+
+    keys = {get_highlight_cache_key(fl.id): fl for fl in files}
+    cached = cache.get_many(list(keys))
     out = {}
 
-    for fl in files:
+    for key, fl in keys.items():
         try:
-            contents = fl.contents.read().decode('utf-8', 'replace')
-            lexer = get_lexer_for_filename(fl.name)
-        except (UnicodeDecodeError, ClassNotFound):
-            out[fl.id] = None
-        else:
-            out[fl.id] = {
-                "lang": lexer.name,
-                "html": highlight(contents, lexer, formatter)
-            }
+            # files which cannot be highlighted are cached as empty dictionaries
+            out[fl.id] = cached[key] or None
+        except KeyError:
+            out[fl.id] = highlight_file(fl.name, fl.contents.read(), formatter)
+            cache.set(key, out[fl.id] or {})
 
     return out
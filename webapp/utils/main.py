@@ -1,4 +1,5 @@
 import bleach
+import hashlib
 import json
 import re
 import markdown
@@ -7,8 +8,10 @@ from algoweb.settings import BLEACH, MARKDOWN_EXT
 
 from django.core import signing
 from django.core.urlresolvers import reverse
+from django.http import FileResponse, Http404
 from django.shortcuts import redirect
 from django.utils import timezone
+from django.utils.http import urlquote
 
 from os.path import basename
 
@@ -45,6 +48,23 @@ def check_files(files, count_limit, size_limit):
     return True, None
 
 
+def get_submission_digest(version, files):
+    """
+    Digest identifying the submission contents evaluated against the given task version
+    :param files: list of SubmissionFile objects
+    :return: hex string or None if some file has no digest (stored before the digests were introduced)
+    """
+    if any(not file.digest for file in files):
+        return None
+
+    digest = hashlib.sha256(str(version).encode('utf-8'))
+
+    for name, file_digest in sorted((file.name, file.digest) for file in files):
+        digest.update(b'\0' + name.encode('utf-8') + b'\0' + file_digest.encode('ascii'))
+
+    return digest.hexdigest()
+
+
 def build_http_array(post, name):
     """
     builds a dictionary of dictionaries out of flat HTTP field data
@@ -93,7 +113,7 @@ def submission_operation_create(user, action, s_ids, task_id, redirect_to, bulk=
         is_bulk=bulk
     )
     rd = redirect('staff_task_operation_handle', sop_uuid=op.uuid, task_id=task_id)
-    rd['Location'] += '?next={}'.format(redirect_to)
+    rd['Location'] += '?next={}'.format(urlquote(redirect_to))
     return rd
 
 
@@ -116,3 +136,16 @@ def evaluation_set_validity(evaluations, valid, reason=None, invoker_id=None):
             evaluation.save()
 
     return True
+
+
+def full_output_response(test):
+    """
+    Sends the full (gzipped) output of the test which was truncated when the report was stored
+    """
+    if not test.full_output:
+        raise Http404('Full output of this test is not stored')
+
+    test.full_output.open('rb')
+    response = FileResponse(test.full_output, content_type='application/gzip')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(basename(test.full_output.name))
+    return response
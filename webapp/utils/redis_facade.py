@@ -1,91 +1,875 @@
 import json
+import threading
+import time
+import zlib
 from os.path import basename, splitext
 
 import redis
 
-from algoweb.settings import PACKAGE_URL, REDIS_POOL_CONFIG
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+from algoweb.settings import PACKAGE_URL, QUEUE_SCHEDULER, REDIS_POOL_CONFIG, SUBMISSION_ADMISSION, \
+    SUBMISSION_COMPRESSION, WORKER_REGISTRY
 from webapp.utils.main import get_package_link
 
-connection_pool = redis.ConnectionPool(**REDIS_POOL_CONFIG)
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+QUEUE_PRIORITIES = ['high', 'medium', 'low']
+
+# result of manage.py findorphans
+ORPHAN_REPORT_KEY = 'queue:orphans'
+
+# submissions waiting for the scheduler (zset of UUIDs scored by the virtual start time), their queue items
+# (prefixed with the priority), the current virtual time and arrival times of the submissions, see QUEUE_SCHEDULER
+SCHEDULER_QUEUE_KEY = 'queue:scheduled'
+SCHEDULER_ITEMS_KEY = 'queue:scheduled:items'
+SCHEDULER_VTIME_KEY = 'queue:scheduled:vtime'
+SCHEDULER_ARRIVAL_KEY = 'queue:scheduled:arrival'
+# the scheduled submissions are moved to the list of the highest priority, see DISPATCH_SCRIPT
+SCHEDULER_DISPATCH_PRIORITY = QUEUE_PRIORITIES[0]
+
+# submissions admitted to the queue and not evaluated yet (zsets of UUIDs scored by the admission time)
+# and the token buckets of the users, see SUBMISSION_ADMISSION
+ADMISSION_IN_FLIGHT_KEY = 'admission:in_flight'
+ADMISSION_BUCKET_KEY = 'admission:bucket'
+
+# Stores submission files, assigns the sequence number and pushes the item to both the queue list
+# and the order zset atomically. The sequence number is needed as a zset score, so it cannot be
+# done within a plain MULTI/EXEC transaction without an additional round trip.
+# KEYS: submission hash, queue counter, queue order zset, queue list
+# ARGV: uuid, queue item, file field/value pairs...
+ENQUEUE_SCRIPT = """
+if #ARGV > 2 then
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 3))
+end
+local seq = redis.call('INCRBY', KEYS[2], 1)
+redis.call('ZADD', KEYS[3], seq, ARGV[1])
+redis.call('RPUSH', KEYS[4], ARGV[2])
+return seq
+"""
+
+# Stores submission files and puts the submission to the scheduler queue. The start time is the latest of
+# the current virtual time and the finish times of both flows (user and task), the finish times of the flows
+# are advanced by their costs and expire when the flows are idle. The arrival time is kept for the aging.
+# KEYS: submission hash, scheduler zset, scheduler items hash, virtual time, user flow, task flow, arrival zset
+# ARGV: uuid, priority, queue item, user cost, task cost, flow ttl, arrival time, file field/value pairs...
+SCHEDULE_SCRIPT = """
+if #ARGV > 7 then
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 8))
+end
+local vtime = tonumber(redis.call('GET', KEYS[4]) or '0')
+local user_finish = tonumber(redis.call('GET', KEYS[5]) or '0')
+local task_finish = tonumber(redis.call('GET', KEYS[6]) or '0')
+local start = math.max(vtime, user_finish, task_finish)
+redis.call('SET', KEYS[5], tostring(start + tonumber(ARGV[4])), 'EX', ARGV[6])
+redis.call('SET', KEYS[6], tostring(start + tonumber(ARGV[5])), 'EX', ARGV[6])
+redis.call('ZADD', KEYS[2], tostring(start), ARGV[1])
+redis.call('ZADD', KEYS[7], ARGV[7], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2] .. ':' .. ARGV[3])
+return 0
+"""
+
+# Moves the submissions with the lowest start times from the scheduler to the list of the highest priority
+# until there are 'prefetch' items in the worker lists, assigning the sequence numbers like ENQUEUE_SCRIPT does.
+# The workers take the items of the higher priorities first, so the scheduler (which already weighs
+# the priorities) has to use a single list to keep its order.
+# A submission waiting for more than 'max wait' seconds is moved first regardless of its start time (aging),
+# the virtual time follows only the submissions taken in the fair order.
+# KEYS: scheduler zset, scheduler items hash, virtual time, arrival zset,
+#       queue list, queue order zset and queue counter of the highest priority, lists of the other priorities
+# ARGV: prefetch, current time, max wait
+# returns: number of moved submissions
+DISPATCH_SCRIPT = """
+local queued = redis.call('LLEN', KEYS[5])
+for i = 8, #KEYS do
+    queued = queued + redis.call('LLEN', KEYS[i])
+end
+local moved = 0
+while queued < tonumber(ARGV[1]) do
+    local uuid
+    local oldest = redis.call('ZRANGE', KEYS[4], 0, 0, 'WITHSCORES')
+    if #oldest > 0 and tonumber(ARGV[2]) - tonumber(oldest[2]) > tonumber(ARGV[3]) then
+        uuid = oldest[1]
+    else
+        local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+        if #head == 0 then
+            break
+        end
+        uuid = head[1]
+        redis.call('SET', KEYS[3], head[2])
+    end
+    redis.call('ZREM', KEYS[1], uuid)
+    redis.call('ZREM', KEYS[4], uuid)
+    local item = redis.call('HGET', KEYS[2], uuid)
+    redis.call('HDEL', KEYS[2], uuid)
+    if item then
+        local seq = redis.call('INCRBY', KEYS[7], 1)
+        redis.call('ZADD', KEYS[6], seq, uuid)
+        redis.call('RPUSH', KEYS[5], string.sub(item, string.find(item, ':', 1, true) + 1))
+        queued = queued + 1
+        moved = moved + 1
+    end
+end
+return moved
+"""
+
+# Finds the sequence number of the first item in each queue, so the position of any queued submission
+# is just a subtraction. The head is read from the order zset, if the entry is missing then it is derived
+# from the counter assuming that the worker takes the items in FIFO order.
+# KEYS: queue list, queue order zset and queue counter for every priority (from the highest)
+# returns: head sequence number and queue length for every priority
+QUEUE_HEADS_SCRIPT = """
+local out = {}
+for i = 1, #KEYS, 3 do
+    local length = redis.call('LLEN', KEYS[i])
+    local head = false
+    local first = redis.call('LINDEX', KEYS[i], 0)
+    if first then
+        local ok, item = pcall(cjson.decode, first)
+        if ok and type(item) == 'table' and item['uuid'] then
+            head = redis.call('ZSCORE', KEYS[i + 1], item['uuid'])
+        end
+    end
+    if not head then
+        head = (tonumber(redis.call('GET', KEYS[i + 2])) or 0) - length + 1
+    end
+    table.insert(out, tonumber(head))
+    table.insert(out, length)
+end
+return out
+"""
+
+# Admits the submission to the queue: checks the queue depth, the numbers of submissions in flight
+# and the token bucket of the user, then takes a token and counts the submission as in flight.
+# Submissions in flight for too long are forgotten on the way. Negative limit means no limit.
+# KEYS: global, group and user in-flight zsets, user token bucket, queue lists, scheduler zset
+# ARGV: uuid, current time, in-flight timeout, global limit, group limit, user limit,
+#       bucket size, bucket refill (seconds per token), reject depth
+# returns: {verdict, seconds until the next token (when rate limited), queue depth}
+ADMIT_SCRIPT = """
+local now = tonumber(ARGV[2])
+local depth = redis.call('ZCARD', KEYS[#KEYS])
+for i = 5, #KEYS - 1 do
+    depth = depth + redis.call('LLEN', KEYS[i])
+end
+if depth >= tonumber(ARGV[9]) then
+    return {'depth', 0, depth}
+end
+local scopes = {'global', 'group', 'user'}
+for i = 1, 3 do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now - tonumber(ARGV[3]))
+    local limit = tonumber(ARGV[i + 3])
+    if limit >= 0 and redis.call('ZCARD', KEYS[i]) >= limit then
+        return {scopes[i], 0, depth}
+    end
+end
+local size = tonumber(ARGV[7])
+local refill = tonumber(ARGV[8])
+local bucket = redis.call('HMGET', KEYS[4], 'tokens', 'time')
+local tokens = size
+if bucket[1] then
+    tokens = math.min(size, tonumber(bucket[1]) + (now - tonumber(bucket[2])) / refill)
+end
+if tokens < 1 then
+    return {'rate', math.ceil((1 - tokens) * refill), depth}
+end
+redis.call('HMSET', KEYS[4], 'tokens', tostring(tokens - 1), 'time', ARGV[2])
+redis.call('EXPIRE', KEYS[4], math.ceil(size * refill))
+for i = 1, 3 do
+    redis.call('ZADD', KEYS[i], ARGV[2], ARGV[1])
+end
+return {'ok', 0, depth}
+"""
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """
+    Connection pool which waits for a free connection (up to 'timeout' seconds) instead of failing
+    and counts its usage. Connections are checked lazily, see 'health_check_interval' in REDIS_POOL_CONFIG
+    """
+    def __init__(self, *args, **kwargs):
+        self.metrics_lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.waiting = 0
+        super().__init__(*args, **kwargs)
+
+    def make_connection(self):
+        with self.metrics_lock:
+            self.created += 1
+
+        return super().make_connection()
+
+    def get_connection(self, command_name, *keys, **options):
+        with self.metrics_lock:
+            self.waiting += 1
+
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        finally:
+            with self.metrics_lock:
+                self.waiting -= 1
+
+        with self.metrics_lock:
+            self.in_use += 1
+
+        return connection
+
+    def release(self, connection):
+        with self.metrics_lock:
+            self.in_use -= 1
+
+        super().release(connection)
+
+    def resize(self, max_connections):
+        """
+        Changes the size of the pool, has to be called before any connection is made
+        """
+        self.max_connections = max_connections
+        self.reset()
+
+    def get_metrics(self):
+        with self.metrics_lock:
+            return {
+                'max_connections': self.max_connections,
+                'created': self.created,
+                'in_use': self.in_use,
+                'waiting': self.waiting
+            }
+
+
+# single pool per process, used by the web views as well as the management commands
+connection_pool = MeteredConnectionPool(**REDIS_POOL_CONFIG)
+
+enqueue_script = redis.Redis(connection_pool=connection_pool).register_script(ENQUEUE_SCRIPT)
+queue_heads_script = redis.Redis(connection_pool=connection_pool).register_script(QUEUE_HEADS_SCRIPT)
+schedule_script = redis.Redis(connection_pool=connection_pool).register_script(SCHEDULE_SCRIPT)
+dispatch_script = redis.Redis(connection_pool=connection_pool).register_script(DISPATCH_SCRIPT)
+admit_script = redis.Redis(connection_pool=connection_pool).register_script(ADMIT_SCRIPT)
 
 
 def get_redis(**kwargs) -> redis.Redis:
-    rs = redis.Redis(connection_pool=connection_pool, **kwargs)
-    rs.ping()
-    return rs
+    """
+    Creating the client is cheap, connections are taken from the pool only for the time of a command
+    """
+    return redis.Redis(connection_pool=connection_pool, **kwargs)
 
 
-def upload_submission(submission):
-    rs = get_redis()
+def get_pool_metrics():
+    return connection_pool.get_metrics()
 
-    for file in submission.submissionfile_set.all():
-        rs.hset("submission:%s" % submission.uuid, "file:%s" % file.name, file.contents.read())
 
+def get_queue_item(submission):
+    """
+    Builds the queue item which is consumed by the worker
+    """
     download_url = get_package_link(submission.task)
 
-    if submission.queue_priority not in ['high', 'medium', 'low']:
-        raise RuntimeError('Invalid queue_priority, expected one from: high, medium, low')
-
-    submission.queue_seq_number = rs.incrby("queue:{}:counter".format(submission.queue_priority), 1)
-
-    rs.zadd("queue:{}:order".format(submission.queue_priority), submission.uuid, submission.queue_seq_number)
-
-    rs.rpush("queue:{}".format(submission.queue_priority), json.dumps({
-        "uuid": submission.uuid,
+    return {
+        "uuid": str(submission.uuid),
         "package": {
             "name": splitext(basename(submission.task.package.name))[0],
             "version": submission.task.version,
             "url": PACKAGE_URL + download_url
         },
         "features": ["async_report"]
-    }))
+    }
+
+
+def get_compressor(compression):
+    """
+    Returns an object with compress() and flush() methods for the given algorithm
+    """
+    if compression == 'zlib':
+        return zlib.compressobj()
+
+    if compression == 'lz4':
+        if lz4 is None:
+            raise ImproperlyConfigured('SUBMISSION_COMPRESSION is set to lz4, but the lz4 package is not installed')
+
+        return Lz4Compressor()
+
+    raise ImproperlyConfigured('Unknown SUBMISSION_COMPRESSION value: {}'.format(compression))
+
+
+class Lz4Compressor:
+    def __init__(self):
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        out = self.header + self.compressor.compress(data)
+        self.header = b''
+        return out
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+def read_file_contents(file, compression=None):
+    """
+    Reads the file chunk by chunk, compressing it on the fly if requested
+    :param file: django File object (either UploadedFile or the one obtained from the storage)
+    :return: contents of the file as bytes
+    """
+    if compression is None:
+        return b''.join(file.chunks())
+
+    compressor = get_compressor(compression)
+    parts = [compressor.compress(chunk) for chunk in file.chunks()]
+    parts.append(compressor.flush())
+
+    return b''.join(parts)
+
+
+def get_schedule(flow, task_id, priority, deadline=None, now=None):
+    """
+    Computes the flows and costs of the submission for the scheduler, see QUEUE_SCHEDULER
+    :param flow: name of the flow the submission is accounted to (e.g. "user:<id>")
+    :param deadline: deadline of the task, the submissions are boosted when it is close
+    :param now: current time, used by the simulation
+    :return: (user flow key, task flow key, user cost, task cost, arrival time) or None if the scheduler is disabled
+    """
+    if not QUEUE_SCHEDULER['enabled']:
+        return None
+
+    now = now or timezone.now()
+    weight = QUEUE_SCHEDULER['priority_weights'][priority]
+
+    if deadline is not None:
+        left = (deadline - now).total_seconds()
+
+        if 0 <= left <= QUEUE_SCHEDULER['deadline_window']:
+            weight *= QUEUE_SCHEDULER['deadline_boost']
+
+    return (
+        "queue:flow:%s" % flow,
+        "queue:flow:task:%s" % task_id,
+        1.0 / weight,
+        1.0 / (weight * QUEUE_SCHEDULER['task_weight']),
+        now.timestamp()
+    )
+
+
+def enqueue_submission(rs, uuid, priority, files, queue_item, compression=None, schedule=None):
+    """
+    Pushes the submission to the queue in a single round trip
+    :param rs: Redis client (or pipeline) to be used
+    :param files: iterable of (name, contents) tuples
+    :param queue_item: dictionary which will be sent to the worker
+    :param compression: name of the algorithm the file contents are compressed with, stored in the hash
+    :param schedule: result of get_schedule, the submission is put to the scheduler instead of the worker list
+    (call dispatch_scheduled afterwards, so it does not wait for the poller)
+    :return: sequence number assigned to the submission, 0 if scheduled (or pipeline if such was given)
+    """
+    if priority not in QUEUE_PRIORITIES:
+        raise RuntimeError('Invalid queue_priority, expected one from: high, medium, low')
 
+    file_args = ["compression", compression] if compression else []
+
+    for name, contents in files:
+        file_args.extend(["file:%s" % name, contents])
+
+    if schedule is not None:
+        user_flow, task_flow, user_cost, task_cost, arrival = schedule
+        keys = [
+            "submission:%s" % uuid,
+            SCHEDULER_QUEUE_KEY,
+            SCHEDULER_ITEMS_KEY,
+            SCHEDULER_VTIME_KEY,
+            user_flow,
+            task_flow,
+            SCHEDULER_ARRIVAL_KEY
+        ]
+        # idle flows expire, their finish times are behind the virtual time by then anyway
+        args = [uuid, priority, json.dumps(queue_item), user_cost, task_cost, 86400, arrival]
+
+        return schedule_script(keys=keys, args=args + file_args, client=rs)
+
+    keys = [
+        "submission:%s" % uuid,
+        "queue:{}:counter".format(priority),
+        "queue:{}:order".format(priority),
+        "queue:{}".format(priority)
+    ]
+
+    return enqueue_script(keys=keys, args=[uuid, json.dumps(queue_item)] + file_args, client=rs)
+
+
+def upload_submission(submission, uploaded_files=None):
+    """
+    Uploads the submission to the worker queue
+    :param uploaded_files: list of UploadedFile objects received in the request, when given
+    the files are sent straight from them instead of being read back from the storage
+    """
+    if uploaded_files is None:
+        sources = [(file.name, file.contents) for file in submission.submissionfile_set.all()]
+    else:
+        sources = [(file.name, file) for file in uploaded_files]
+
+    files = [(name, read_file_contents(file, SUBMISSION_COMPRESSION)) for name, file in sources]
+
+    schedule = get_schedule('user:%s' % submission.user_id, submission.task_id, submission.queue_priority,
+                            submission.task.deadline)
+
+    pipe = get_redis().pipeline(transaction=False)
+    enqueue_submission(
+        pipe,
+        str(submission.uuid),
+        submission.queue_priority,
+        files,
+        get_queue_item(submission),
+        SUBMISSION_COMPRESSION,
+        schedule
+    )
+
+    if schedule is not None:
+        dispatch_scheduled(pipe)
+
+    submission.queue_seq_number = pipe.execute()[0]
     submission.save()
 
 
-def get_submission_status(uuid, queued_priority):
+def dispatch_scheduled(rs=None, now=None):
+    """
+    Moves the scheduled submissions to the worker lists, see DISPATCH_SCRIPT
+    :param rs: Redis client (or pipeline) to be used
+    :param now: current time, used by the simulation
+    :return: number of moved submissions (or pipeline if such was given)
+    """
+    keys = [
+        SCHEDULER_QUEUE_KEY,
+        SCHEDULER_ITEMS_KEY,
+        SCHEDULER_VTIME_KEY,
+        SCHEDULER_ARRIVAL_KEY,
+        "queue:{}".format(SCHEDULER_DISPATCH_PRIORITY),
+        "queue:{}:order".format(SCHEDULER_DISPATCH_PRIORITY),
+        "queue:{}:counter".format(SCHEDULER_DISPATCH_PRIORITY)
+    ]
+    keys.extend("queue:{}".format(priority) for priority in QUEUE_PRIORITIES if priority != SCHEDULER_DISPATCH_PRIORITY)
+    args = [QUEUE_SCHEDULER['prefetch'], (now or timezone.now()).timestamp(), QUEUE_SCHEDULER['max_wait']]
+
+    return dispatch_script(keys=keys, args=args, client=rs or get_redis())
+
+
+def get_admission_keys(user_id, group_id):
+    """
+    :return: global, group and user in-flight zset keys
+    """
+    return [
+        ADMISSION_IN_FLIGHT_KEY,
+        "{}:group:{}".format(ADMISSION_IN_FLIGHT_KEY, group_id),
+        "{}:user:{}".format(ADMISSION_IN_FLIGHT_KEY, user_id)
+    ]
+
+
+def admit_submission(uuid, user_id, group_id, group_limit=None):
+    """
+    Checks whether the submission may enter the queue and counts it as in flight if so, see ADMIT_SCRIPT
+    :param group_limit: limit of submissions in flight in the group, SUBMISSION_ADMISSION is used if None
+    :return: tuple (verdict, seconds until the user may submit again (rate limit only), queue depth),
+    verdict is "ok" or the reason of the rejection ("depth", "global", "group", "user" or "rate")
+    """
+    limits = SUBMISSION_ADMISSION['max_in_flight']
+
+    if group_limit is None:
+        group_limit = limits['group']
+
+    keys = get_admission_keys(user_id, group_id)
+    keys.append("{}:user:{}".format(ADMISSION_BUCKET_KEY, user_id))
+    keys.extend("queue:{}".format(priority) for priority in QUEUE_PRIORITIES)
+    keys.append(SCHEDULER_QUEUE_KEY)
+
+    args = [uuid, time.time(), SUBMISSION_ADMISSION['in_flight_timeout']]
+    args.extend(-1 if limit is None else limit for limit in [limits['global'], group_limit, limits['user']])
+    args.extend([
+        SUBMISSION_ADMISSION['bucket_size'],
+        SUBMISSION_ADMISSION['bucket_refill'],
+        SUBMISSION_ADMISSION['reject_depth']
+    ])
+
+    verdict, retry_after, depth = admit_script(keys=keys, args=args, client=get_redis())
+
+    return verdict.decode('utf-8'), retry_after, depth
+
+
+def release_admissions(submissions, rs=None):
+    """
+    Stops counting the submissions as in flight, has to be called when they are evaluated or dropped
+    :param submissions: list of (uuid, user_id, group_id) tuples
+    :param rs: Redis client to be used, the default one if not given
+    """
+    pipe = (rs or get_redis()).pipeline(transaction=False)
+
+    for uuid, user_id, group_id in submissions:
+        for key in get_admission_keys(user_id, group_id):
+            pipe.zrem(key, uuid)
+
+    pipe.execute()
+
+
+def get_queue_heads(rs):
+    """
+    :param rs: Redis client (or pipeline) to be used
+    :return: dictionary priority => (head sequence number, queue length)
+    """
+    keys = []
+
+    for priority in QUEUE_PRIORITIES:
+        keys.extend([
+            "queue:{}".format(priority),
+            "queue:{}:order".format(priority),
+            "queue:{}:counter".format(priority)
+        ])
+
+    return queue_heads_script(keys=keys, client=rs)
+
+
+def parse_queue_heads(result):
+    return {priority: (result[2 * i], result[2 * i + 1]) for i, priority in enumerate(QUEUE_PRIORITIES)}
+
+
+def get_submission_statuses(submissions):
+    """
+    Resolves statuses of many submissions using a single round trip.
+    The queue position is computed from the submission sequence number and the queue heads,
+    so the cost does not depend on the number of submissions ever queued.
+    Submissions waiting in the scheduler are behind all the items of the worker lists,
+    their sequence numbers are assigned when they are moved to the list of SCHEDULER_DISPATCH_PRIORITY.
+    :param submissions: list of (uuid, queued_priority, queue_seq_number) tuples
+    :return: dictionary uuid => (status_kind, data), status_kind is "queued" (data contains the position),
+    "processing" (data is the status set by the worker) or "not-found" (data is None)
+    """
+    if not submissions:
+        return {}
+
+    pipe = get_redis().pipeline()
+    pipe.mget(['status:%s' % uuid for uuid, queued_priority, seq in submissions])
+    get_queue_heads(pipe)
+
+    for uuid, queued_priority, seq in submissions:
+        if not seq:
+            pipe.zrank(SCHEDULER_QUEUE_KEY, uuid)
+            pipe.zscore("queue:{}:order".format(SCHEDULER_DISPATCH_PRIORITY), uuid)
+        else:
+            pipe.zscore("queue:{}:order".format(queued_priority), uuid)
+
+    results = pipe.execute()
+    statuses, heads = results[:2]
+    heads = parse_queue_heads(heads)
+    lookups = iter(results[2:])
+
+    # number of items in the queues with higher priority
+    offsets = {}
+    ahead = 0
+
+    for priority in QUEUE_PRIORITIES:
+        offsets[priority] = ahead
+        ahead += heads[priority][1]
+
+    out = {}
+
+    for (uuid, queued_priority, seq), status in zip(submissions, statuses):
+        rank = None
+
+        if not seq:
+            rank, order_seq = next(lookups), next(lookups)
+
+            if order_seq is not None:
+                queued_priority, seq = SCHEDULER_DISPATCH_PRIORITY, int(order_seq)
+        else:
+            order_seq = next(lookups)
+
+        if status:
+            out[uuid] = "processing", json.loads(status.decode('utf-8'))
+            continue
+
+        if rank is not None:
+            out[uuid] = "queued", {"position": ahead + rank + 1}
+            continue
+
+        try:
+            head, length = heads[queued_priority]
+        except KeyError:
+            head, length = 0, 0
+
+        if head <= seq < head + length:
+            out[uuid] = "queued", {"position": seq - head + offsets[queued_priority] + 1}
+        elif order_seq is not None:
+            # taken by the worker which has not set the status yet, the order entry is removed
+            # when the evaluation is stored (or by manage.py cleanqueue if the submission is lost)
+            out[uuid] = "processing", {"status": "preparing", "progress": 0}
+        else:
+            out[uuid] = "not-found", None
+
+    return out
+
+
+def trim_queue_order():
+    """
+    Removes the entries of submissions which have already left the queue from the order zsets
+    :return: dictionary priority => (number of removed entries, head drift)
+    head drift is non-zero if the queue was not consumed in FIFO order, then reported positions are approximate
+    """
     rs = get_redis()
+    heads = parse_queue_heads(get_queue_heads(rs))
+
+    pipe = rs.pipeline()
+
+    for priority in QUEUE_PRIORITIES:
+        pipe.get("queue:{}:counter".format(priority))
+        pipe.zremrangebyscore("queue:{}:order".format(priority), '-inf', '({}'.format(heads[priority][0]))
+
+    results = pipe.execute()
+    out = {}
+
+    for i, priority in enumerate(QUEUE_PRIORITIES):
+        head, length = heads[priority]
+        expected_head = int(results[2 * i] or 0) - length + 1
+        out[priority] = results[2 * i + 1], head - expected_head
+
+    return out
+
+
+def get_status_channel(uuid):
+    """
+    Name of the pub/sub channel announcing that the submission evaluation was stored
+    """
+    return 'submission_status:%s' % uuid
 
-    status = rs.get('status:%s' % uuid)
 
-    if status:
-        return "processing", json.loads(status.decode('utf-8'))
+def submissions_evaluated(submissions, rs=None):
+    """
+    Drops the submissions from the queue order zsets, removes their evaluation hashes (the outputs are
+    already stored in the database) and announces that their evaluations were stored
+    :param submissions: list of (uuid, queued_priority) tuples
+    :param rs: Redis client to be used, the default one if not given
+    """
+    pipe = (rs or get_redis()).pipeline(transaction=False)
 
-    queue_pos = rs.zrank("queue:{}:order".format(queued_priority), uuid)
+    for uuid, queued_priority in submissions:
+        pipe.zrem("queue:{}:order".format(queued_priority), uuid)
 
-    if queue_pos is None:
-        return "not-found", None
+        # the scheduled submissions are moved to the list of SCHEDULER_DISPATCH_PRIORITY, see DISPATCH_SCRIPT
+        if queued_priority != SCHEDULER_DISPATCH_PRIORITY:
+            pipe.zrem("queue:{}:order".format(SCHEDULER_DISPATCH_PRIORITY), uuid)
+        pipe.delete("evaluation:%s" % uuid)
+        pipe.publish(get_status_channel(uuid), 'evaluated')
 
-    if queued_priority == "medium" or queued_priority == "low":
-        queue_pos += rs.zcard("queue:high:order")
+    pipe.execute()
 
-    if queued_priority == "low":
-        queue_pos += rs.zcard("queue:medium:order")
 
-    return "queued", {"position": int(queue_pos) + 1}
+def get_worker_key(worker_name):
+    return "queue:alive_workers:%s" % worker_name
+
+
+def discover_workers(rs):
+    """
+    Finds the alive worker keys incrementally, so Redis is not blocked like with KEYS
+    :return: list of worker names
+    """
+    prefix = get_worker_key('')
+
+    return [key.decode('utf-8')[len(prefix):]
+            for key in rs.scan_iter(match=prefix + '*', count=WORKER_REGISTRY['scan_count'])]
 
 
 def get_worker_list():
+    """
+    Reads the workers from the registry and their states with a single MGET. Workers whose alive key
+    has expired are pruned. Once per WORKER_REGISTRY['scan_interval'] seconds (or when the registry
+    is empty) the registry is completed using SCAN.
+    :return: sorted list of (worker name, state) tuples
+    """
     rs = get_redis()
+    registry = WORKER_REGISTRY['key']
+    now = time.time()
+
+    pipe = rs.pipeline()
+    pipe.zrange(registry, 0, -1)
+    pipe.set(registry + ':scanned', 1, ex=WORKER_REGISTRY['scan_interval'], nx=True)
+    registered, scan_due = pipe.execute()
+
+    names = {name.decode('utf-8') for name in registered}
+
+    # workers which do not register themselves would be missing until the next scan otherwise
+    if scan_due or not names:
+        names.update(discover_workers(rs))
+
+    if not names:
+        return []
+
+    names = sorted(names)
+    states = rs.mget([get_worker_key(name) for name in names])
+
+    worker_list = []
+    seen = {}
+    expired = []
+
+    for name, state in zip(names, states):
+        if state is None:
+            expired.append(name)
+            continue
+
+        worker_list.append((name, json.loads(state.decode('utf-8'))))
+        seen[name] = now
+
+    # the alive key is the heartbeat of the workers which do not register themselves
+    pipe = rs.pipeline()
+
+    if seen:
+        pipe.zadd(registry, seen)
+
+    if expired:
+        pipe.zrem(registry, *expired)
+
+    pipe.execute()
 
-    worker_list = rs.keys("queue:alive_workers:*")
-    state = {}
+    return worker_list
 
-    for worker_key in worker_list:
-        worker_name = worker_key.decode('utf-8').split(':')[2]
-        state[worker_name] = json.loads(rs.get(worker_key).decode('utf-8'))
 
-    return sorted(state.items())
+def get_queue_lengths(rs=None):
+    """
+    :return: dictionary priority => number of queued items, the items waiting in the scheduler are under "scheduled"
+    """
+    pipe = (rs or get_redis()).pipeline(transaction=False)
 
+    for priority in QUEUE_PRIORITIES:
+        pipe.llen("queue:{}".format(priority))
 
-def get_queue_contents():
+    pipe.zcard(SCHEDULER_QUEUE_KEY)
+
+    return dict(zip(QUEUE_PRIORITIES + ['scheduled'], pipe.execute()))
+
+
+def get_queue_window(start, count):
+    """
+    Reads a part of the queue in the order the worker takes it (higher priorities first, then the scheduled
+    submissions in the order of the scheduler), only the requested ranges are transferred
+    :param start: offset of the first item counted across all the priorities
+    :param count: maximum number of items returned
+    :return: (list of queue items with 'priority' and 'position' added, dictionary priority => queue length)
+    """
     rs = get_redis()
+    lengths = get_queue_lengths(rs)
+
+    pipe = rs.pipeline(transaction=False)
+    ranges = []
+    offset = 0
+
+    for priority in QUEUE_PRIORITIES:
+        first = max(start - offset, 0)
+        last = min(start + count - offset, lengths[priority]) - 1
+
+        if first <= last:
+            pipe.lrange("queue:{}".format(priority), first, last)
+            ranges.append((priority, offset + first))
+
+        offset += lengths[priority]
+
+    first = max(start - offset, 0)
+    last = min(start + count - offset, lengths['scheduled']) - 1
+    scheduled_position = offset + first
 
-    for queue_name in ["high", "medium", "low"]:
-        queue_content = rs.lrange("queue:{}".format(queue_name), 0, -1)
+    if first <= last:
+        pipe.zrange(SCHEDULER_QUEUE_KEY, first, last)
 
-        for queue_item in queue_content:
+    results = pipe.execute()
+    items = []
+
+    for (priority, position), queue_content in zip(ranges, results):
+        for index, queue_item in enumerate(queue_content):
+            item_data = json.loads(queue_item.decode('utf-8'))
+            item_data['priority'] = priority
+            item_data['position'] = position + index + 1
+            items.append(item_data)
+
+    if first <= last and results[-1]:
+        scheduled_items = rs.hmget(SCHEDULER_ITEMS_KEY, results[-1])
+
+        for index, scheduled_item in enumerate(scheduled_items):
+            if scheduled_item is None:
+                # dispatched in the meantime
+                continue
+
+            priority, queue_item = scheduled_item.decode('utf-8').split(':', 1)
             item_data = json.loads(queue_item)
-            item_data['priority'] = queue_name
+            item_data['priority'] = '{} (scheduled)'.format(priority)
+            item_data['position'] = scheduled_position + index + 1
+            items.append(item_data)
+
+    return items, lengths
+
+
+def iter_queue_uuids(chunk_size=1000):
+    """
+    Iterates over UUIDs of all the queued (or scheduled) submissions reading them in chunks, so Redis is not blocked.
+    The lists are read from the tail, the worker takes items from the head and new items are appended
+    to the tail, so no item which stays in the queue is skipped (some may be returned twice).
+    """
+    rs = get_redis()
+
+    for priority in QUEUE_PRIORITIES:
+        end = -1
+
+        while True:
+            queue_content = rs.lrange("queue:{}".format(priority), end - chunk_size + 1, end)
+
+            for queue_item in queue_content:
+                yield json.loads(queue_item.decode('utf-8'))['uuid']
+
+            if len(queue_content) < chunk_size:
+                break
+
+            end -= chunk_size
+
+    # SCAN returns all the members which stay in the zset during the whole iteration
+    for uuid in rs.zscan_iter(SCHEDULER_QUEUE_KEY, count=chunk_size):
+        yield uuid[0].decode('utf-8')
+
+
+def get_processing_uuids(uuids, chunk_size=1000):
+    """
+    :return: set of the given UUIDs which have a status key set by the worker
+    """
+    rs = get_redis()
+    uuids = list(uuids)
+    out = set()
+
+    for i in range(0, len(uuids), chunk_size):
+        chunk = uuids[i:i + chunk_size]
+        out.update(uuid for uuid, status in zip(chunk, rs.mget(['status:%s' % uuid for uuid in chunk])) if status)
+
+    return out
+
+
+def store_orphan_report(uuids, waiting, limit):
+    """
+    Stores the result of manage.py findorphans, so it does not have to be computed when the page is loaded
+    :param uuids: list of UUIDs of the submissions which are waiting for evaluation, but are not in the queue
+    :param waiting: number of all the submissions waiting for evaluation
+    :param limit: maximum number of UUIDs stored, the total number is stored anyway
+    """
+    get_redis().set(ORPHAN_REPORT_KEY, json.dumps({
+        'checked': time.time(),
+        'count': len(uuids),
+        'waiting': waiting,
+        'uuids': uuids[:limit]
+    }))
+
+
+def get_orphan_report():
+    """
+    :return: dictionary with 'checked' (unix time), 'count', 'waiting' and 'uuids' keys or None if the check
+    was never run
+    """
+    report = get_redis().get(ORPHAN_REPORT_KEY)
+
+    if report is None:
+        return None
 
-            yield item_data
+    return json.loads(report.decode('utf-8'))
@@ -0,0 +1,170 @@
+import json
+import logging
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import redis
+
+from django.db import connection, transaction
+from django.db.models import BigIntegerField, Case, Value, When
+from django.utils import timezone
+
+from algoweb.settings import REEVALUATION_BATCH_SIZE, REEVALUATION_STALE_TIMEOUT, REEVALUATION_WORKERS, \
+    SUBMISSION_COMPRESSION
+from webapp.models import Submission, SubmissionFile, SubmissionOperation
+from webapp.utils.main import get_submission_digest
+from webapp.utils.redis_facade import dispatch_scheduled, enqueue_submission, get_queue_item, get_redis, \
+    get_schedule, read_file_contents
+
+# created on the first re-evaluation, so the processes which never re-evaluate do not start any threads
+reevaluation_executor = None
+
+
+def reevaluate_batch(task, invoker_id, old_submissions):
+    """
+    Copies the submissions and pushes the copies to the queue, the database is touched by a constant
+    number of queries and the whole batch is enqueued within a single round trip
+    :param old_submissions: list of Submission objects with prefetched submissionfile_set
+    :return: list of created Submission objects
+    """
+    new_submissions = []
+    new_files = []
+
+    for old_submission in old_submissions:
+        old_files = old_submission.submissionfile_set.all()
+        new_s = Submission(
+            uuid=uuid.uuid4(),
+            user_id=old_submission.user_id,
+            task=task,
+            reevaluated=True,
+            copy_of=old_submission,
+            invoked_by_id=invoker_id,
+            queue_priority="low",
+            digest=get_submission_digest(task.version, old_files)
+        )
+        new_submissions.append(new_s)
+        # the copies point to the already stored files, nothing is written to the storage
+        new_files.extend(SubmissionFile(submission=new_s, name=file.name, contents=file.contents.name,
+                                        digest=file.digest)
+                         for file in old_files)
+
+    with transaction.atomic():
+        Submission.objects.bulk_create(new_submissions)
+        SubmissionFile.objects.bulk_create(new_files)
+
+    pipe = get_redis().pipeline(transaction=False)
+    # re-evaluations invoked by a staff member share a single flow, so they do not outweigh the students
+    schedule = get_schedule('invoker:%s' % invoker_id, task.id, "low", task.deadline)
+
+    for new_s, old_submission in zip(new_submissions, old_submissions):
+        files = [(file.name, read_file_contents(file.contents, SUBMISSION_COMPRESSION))
+                 for file in old_submission.submissionfile_set.all()]
+        enqueue_submission(pipe, str(new_s.uuid), new_s.queue_priority, files, get_queue_item(new_s),
+                           SUBMISSION_COMPRESSION, schedule)
+
+    if schedule is not None:
+        dispatch_scheduled(pipe)
+
+    try:
+        seq_numbers = pipe.execute()[:len(new_submissions)]
+    except redis.exceptions.RedisError:
+        Submission.objects.filter(pk__in=[new_s.pk for new_s in new_submissions]).delete()
+        raise
+
+    Submission.objects.filter(pk__in=[new_s.pk for new_s in new_submissions]).update(queue_seq_number=Case(
+        *[When(pk=new_s.pk, then=Value(seq)) for new_s, seq in zip(new_submissions, seq_numbers)],
+        output_field=BigIntegerField()
+    ))
+
+    return new_submissions
+
+
+def run_reevaluation(op_id, submission_ids):
+    """
+    Re-evaluates the submissions in batches, the progress is stored in the SubmissionOperation row
+    and the UUIDs of the new submissions are appended to its 'extra' field
+    :param submission_ids: list of primary keys of the submissions to be re-evaluated
+    """
+    # the operation may have been marked as interrupted while waiting for the thread, see mark_stale_reevaluation
+    if not SubmissionOperation.objects.filter(pk=op_id, finished=None).update(heartbeat=timezone.now()):
+        return
+
+    op = SubmissionOperation.objects.select_related('task').get(pk=op_id)
+    pending = []
+    error = None
+
+    try:
+        for i in range(0, len(submission_ids), REEVALUATION_BATCH_SIZE):
+            old_submissions = list(Submission.objects.filter(pk__in=submission_ids[i:i + REEVALUATION_BATCH_SIZE])
+                                   .prefetch_related('submissionfile_set'))
+
+            pending.extend(str(new_s.uuid) for new_s in reevaluate_batch(op.task, op.invoker_id, old_submissions))
+
+            SubmissionOperation.objects.filter(pk=op_id).update(progress=len(pending), extra=json.dumps(pending),
+                                                                heartbeat=timezone.now())
+    except redis.exceptions.RedisError:
+        logging.exception('Unable to enqueue re-evaluated submissions of operation {}'.format(op_id))
+        error = 'Unable to push the submissions to the queue, {} of {} were re-evaluated'.format(
+            len(pending), len(submission_ids))
+    except Exception:
+        logging.exception('Re-evaluation {} failed'.format(op_id))
+        error = 'Re-evaluation failed, {} of {} submissions were re-evaluated'.format(
+            len(pending), len(submission_ids))
+
+    SubmissionOperation.objects.filter(pk=op_id).update(finished=timezone.now(), error=error)
+
+
+def run_reevaluation_thread(op_id, submission_ids):
+    try:
+        run_reevaluation(op_id, submission_ids)
+    finally:
+        # the connection belongs to the executor thread, it would never be closed otherwise
+        connection.close()
+
+
+def start_reevaluation(op, submission_ids):
+    """
+    Starts the re-evaluation in a background thread (or runs it immediately if REEVALUATION_WORKERS is 0)
+    :param op: SubmissionOperation object
+    :param submission_ids: list of primary keys of the submissions to be re-evaluated
+    """
+    global reevaluation_executor
+
+    op.has_started = True
+    op.total = len(submission_ids)
+    op.progress = 0
+    op.extra = json.dumps([])
+    op.heartbeat = timezone.now()
+    op.save()
+
+    if not REEVALUATION_WORKERS:
+        run_reevaluation(op.pk, submission_ids)
+        return
+
+    if reevaluation_executor is None:
+        reevaluation_executor = ThreadPoolExecutor(REEVALUATION_WORKERS, thread_name_prefix='reevaluation')
+
+    # the row has to be committed before the thread reads it
+    transaction.on_commit(lambda: reevaluation_executor.submit(run_reevaluation_thread, op.pk, submission_ids))
+
+
+def mark_stale_reevaluation(op):
+    """
+    Marks the unfinished re-evaluation as failed if it made no progress for REEVALUATION_STALE_TIMEOUT seconds,
+    the thread running it was most probably lost together with its process
+    :param op: SubmissionOperation object, updated in place
+    """
+    if not op.has_started or op.finished or op.action != 'reevaluate':
+        return
+
+    now = timezone.now()
+    error = 'Re-evaluation was interrupted, {} of {} submissions were re-evaluated'.format(op.progress, op.total)
+
+    if SubmissionOperation.objects.filter(
+            pk=op.pk, finished=None, heartbeat__lt=now - timedelta(seconds=REEVALUATION_STALE_TIMEOUT)
+    ).update(finished=now, error=error):
+        logging.warning('Re-evaluation {} was interrupted'.format(op.pk))
+        op.finished = now
+        op.error = error
@@ -2,15 +2,17 @@ import os
 
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from werkzeug.exceptions import Forbidden
 
 import algoweb.settings
 import json
 import redis
 import uuid
+import zlib
 
 from datetime import timedelta
+from time import monotonic
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
@@ -20,8 +22,9 @@ from django.core.mail import EmailMessage
 from django.core.signing import TimestampSigner, SignatureExpired
 from django.core.urlresolvers import reverse
 from django.db.models import F
-from django.db.models.expressions import RawSQL
-from django.http import HttpResponseRedirect, Http404, HttpResponse, JsonResponse
+from django.db.models.expressions import Exists, OuterRef
+from django.http import HttpResponseRedirect, Http404, HttpResponse, JsonResponse, HttpResponseBadRequest, \
+    StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
@@ -32,12 +35,28 @@ from os.path import basename, join as path_join
 from webapp.forms import FeedbackFrom, InternalLoginForm, InternalRegisterForm, PasswordForgetInitForm, \
     PasswordForgetResetForm
 from webapp.models import Task, Submission, SubmissionFile, SubmissionEvaluation, SubmissionTest, TaskGroup, \
-    TaskGroupAccess, TaskGroupInviteToken, TaskGroupSet
-from webapp.utils.highlight import highlight_submission_files
-from webapp.utils.redis_facade import upload_submission, get_submission_status
-from webapp.utils.main import check_files, apply_markdown
+    TaskGroupAccess, TaskGroupInviteToken, TaskGroupSet, TaskUserResult, TaskUserUsage
+from webapp.utils.admission import check_admission, get_queue_state
+from webapp.utils.highlight import highlight_submission_files, prerender_submission_files
+from webapp.utils.redis_facade import upload_submission, get_submission_statuses, get_redis, get_status_channel, \
+    release_admissions
+from webapp.utils.main import check_files, apply_markdown, full_output_response, get_submission_digest
+from webapp.utils.time import format_int
 from algoweb.settings import EMAIL_SENDER_RESET, EMAIL_SENDER_NOTIFIER, EMAIL_RECIPIENT_NOTIFIER, \
-    INTERNAL_USERNAME_FORMAT, CAS_SERVER_NAME, BASE_DIR
+    INTERNAL_USERNAME_FORMAT, CAS_SERVER_NAME, BASE_DIR, SUBMISSION_STATUS_STREAM, SUBMISSION_STATUS_POLLING, \
+    SUBMISSION_ADMISSION
+
+# messages shown when the submission is not admitted to the queue, see SUBMISSION_ADMISSION
+ADMISSION_MESSAGES = {
+    'depth': 'The evaluation queue is full at the moment. Submission rejected, please try again later',
+    'global': 'Too many submissions are waiting for evaluation at the moment. Submission rejected, '
+              'please try again later',
+    'group': 'Too many submissions to this group are waiting for evaluation at the moment. Submission rejected, '
+             'please try again later',
+    'user': 'You already have too many submissions waiting for evaluation. Submission rejected, '
+            'please wait for their results',
+    'rate': 'You are submitting too often. Submission rejected, please try again later'
+}
 
 
 def index(request):
@@ -75,30 +94,47 @@ def feedback(request):
 
 @login_required
 def tasks(request):
-
-    items = []
+    task_groups = []
 
     for task_group in TaskGroup.objects.filter(archived=False):
         try:
+            # roles in all the groups are resolved by a single query
             task_group.check_membership(request.user)
         except PermissionDenied:
             continue
 
-        # here we define minimum submission score when the task is considered as "accepted" to be any score
-        # greater than zero. theoretically we could provide a possibility for the tutor to set this value manually.
-        # * in line score__gt
-        has_ok_eval = SubmissionEvaluation.objects.filter(
-            submission__task__in=task_group.task_set.filter(archived=False, published=True),
-            submission__user=request.user,
-            status='ok',
-            score__gt=0
-        ).values_list('submission__task_id', flat=True).distinct('submission__task_id')
+        task_groups.append(task_group)
+
+    # sets and tasks of all the groups are fetched at once and grouped here
+    group_sets = {}
+    set_tasks = {}
+
+    for tg_set in TaskGroupSet.objects.filter(task_group__in=task_groups):
+        group_sets.setdefault(tg_set.task_group_id, []).append(tg_set)
 
+    for task in Task.objects.filter(task_group__in=task_groups, archived=False, published=True):
+        set_tasks.setdefault(task.tg_set_id, []).append(task)
+
+    # here we define minimum submission score when the task is considered as "accepted" to be any score
+    # greater than zero. theoretically we could provide a possibility for the tutor to set this value manually.
+    # * in line score__gt
+    has_ok_eval = set(SubmissionEvaluation.objects.filter(
+        submission__task__task_group__in=task_groups,
+        submission__task__archived=False,
+        submission__task__published=True,
+        submission__user=request.user,
+        status='ok',
+        score__gt=0
+    ).values_list('submission__task_id', flat=True).distinct())
+
+    items = []
+
+    for task_group in task_groups:
         items.append({
             'group': task_group,
             'sets': [
-                dict(set=tg_set, tasks=tg_set.task_set.filter(task_group=task_group, archived=False, published=True))
-                for tg_set in TaskGroupSet.objects.filter(task_group=task_group)
+                dict(set=tg_set, tasks=set_tasks.get(tg_set.id, []))
+                for tg_set in group_sets.get(task_group.id, [])
             ],
             'has_ok_eval': has_ok_eval
         })
@@ -128,9 +164,17 @@ def task(request, task_id):
         'evaluations': {},
         'tokens': {},
         'limits': task.get_user_limits(request.user.id),
-        'deadline': task.get_deadline_data()
+        'deadline': task.get_deadline_data(),
+        'status_stream': SUBMISSION_STATUS_STREAM['enabled'],
+        'queue': None
     }
 
+    if SUBMISSION_ADMISSION['enabled']:
+        try:
+            context['queue'] = get_queue_state()
+        except redis.exceptions.RedisError:
+            pass
+
     evaluations = SubmissionEvaluation.objects.filter(submission__uuid__in=[sbm.uuid for sbm in submissions])
 
     signer = TimestampSigner()
@@ -179,31 +223,96 @@ def task_submit(request, task_id):
         messages.warning(request, message)
         return HttpResponseRedirect(redirect_url)
 
-    count_pending = Submission.objects.filter(submissionevaluation__isnull=True, user=request.user).count()
+    sid = str(uuid.uuid4())
+    # the submission is counted as in flight from now on, every way out below has to release it
+    admitted = [(sid, request.user.id, task.task_group_id)]
 
-    qp = "medium"
+    try:
+        admission = check_admission(sid, request.user.id, task.task_group)
+    except redis.exceptions.RedisError:
+        return render(request, 'webapp/submit_fail.html', {'task': task})
 
-    # if user has already two or more not evaluated submissions then the next ones will go with
-    # low priority, so it would not be possible for a single user to create a total disaster
-    if count_pending >= 2:
-        qp = "low"
+    if not admission.admitted:
+        message = ADMISSION_MESSAGES[admission.reason]
 
-    submission = Submission.objects.create(uuid=str(uuid.uuid4()), user=request.user, task=task, queue_priority=qp)
+        if admission.wait is not None:
+            message += ' (in about {})'.format(format_int(admission.wait))
 
-    for file in files:
-        SubmissionFile.objects.create(submission=submission, name=file.name, contents=file)
+        messages.error(request, message)
+        return HttpResponseRedirect(redirect_url)
 
     try:
-        upload_submission(submission)
-    except redis.exceptions.RedisError:
-        # delete this submission, if we failed to upload it
-        # then it doesn't really exist at all
-        submission.delete()
-        return render(request, 'webapp/submit_fail.html', {'task': task})
+        count_pending = Submission.objects.filter(submissionevaluation__isnull=True, user=request.user).count()
+
+        qp = "medium"
+
+        # if user has already two or more not evaluated submissions then the next ones will go with
+        # low priority, so it would not be possible for a single user to create a total disaster
+        if count_pending >= 2 or admission.deferred:
+            qp = "low"
+
+        with transaction.atomic():
+            # the usage counter stays locked until the submission is created, so concurrent submissions
+            # cannot exceed the limit (the check above only rejects the obvious cases early)
+            if not task.get_user_limits(request.user.id, lock=True).can_submit:
+                release_submission_admission(admitted)
+                messages.error(request, 'You have exceeded limit on amount of submissions')
+                return HttpResponseRedirect(redirect_url)
+
+            submission = Submission.objects.create(uuid=sid, user=request.user, task=task, queue_priority=qp)
+            TaskUserUsage.objects.increment(task.id, request.user.id)
+
+        submission_files = [
+            SubmissionFile.objects.create_from_upload(submission, file) for file in files
+        ]
+
+        submission.digest = get_submission_digest(task.version, submission_files)
+
+        if task.reuse_evaluations and SubmissionEvaluation.objects.reuse(submission):
+            release_submission_admission(admitted)
+            messages.info(request, 'The same files were already evaluated, the previous result was used')
+            prerender_submission_files(submission_files)
+            return HttpResponseRedirect(redirect_url)
+
+        try:
+            # files are sent straight from the request, so there is no need to read them back from the storage
+            upload_submission(submission, files)
+        except redis.exceptions.RedisError:
+            # delete this submission, if we failed to upload it
+            # then it doesn't really exist at all
+            submission.delete()
+            release_submission_admission(admitted)
+            return render(request, 'webapp/submit_fail.html', {'task': task})
+    except Exception:
+        # e.g. the files could not be stored
+        release_submission_admission(admitted)
+        raise
+
+    if admission.deferred:
+        messages.warning(request, 'The evaluation queue is long at the moment, your submission was queued '
+                                  'with low priority{}'.format(
+                                      '' if admission.wait is None else
+                                      ' (expected wait about {})'.format(format_int(admission.wait))))
+
+    prerender_submission_files(submission_files)
 
     return HttpResponseRedirect(redirect_url)
 
 
+def release_submission_admission(submissions):
+    """
+    Releases the admission of the submissions which did not make it to the queue, see check_admission
+    """
+    if not SUBMISSION_ADMISSION['enabled']:
+        return
+
+    try:
+        release_admissions(submissions)
+    except redis.exceptions.RedisError:
+        # the submissions are forgotten after SUBMISSION_ADMISSION['in_flight_timeout'] anyway
+        pass
+
+
 @login_required
 def submission_report(request, submission_id):
     # here no check on membership is done since user should always have access to his submissions (by link)
@@ -235,35 +344,59 @@ def submission_report(request, submission_id):
     return render(request, 'webapp/report.html', context)
 
 
-@require_POST
 @login_required
-@csrf_exempt
-def submission_status(request):
-    try:
-        rq = json.loads(request.body.decode('utf-8'))
-    except UnicodeDecodeError:
-        return JsonResponse([])
+def download_test_output(request, test_id):
+    test = get_object_or_404(
+        SubmissionTest,
+        pk=test_id,
+        evaluation__submission__user_id=request.user.id,
+        output_visibility='public'
+    )
+
+    return full_output_response(test)
 
+
+def get_signed_submissions(tokens):
+    """
+    Unsigns submission tokens handed out by the task page
+    :return: list of (uuid, queue_priority, queue_seq_number) tuples
+    :except: ValueError, BadSignature in case of invalid token
+    """
+    signer = TimestampSigner()
+    uuids = [signer.unsign(i, max_age=timedelta(hours=24)) for i in tokens]
+    submissions = Submission.objects.filter(uuid__in=uuids).values_list('uuid', 'queue_priority', 'queue_seq_number')
+
+    return [(str(sid), queued_priority, seq) for sid, queued_priority, seq in submissions]
+
+
+def get_status_entries(submission_list, check_db=True):
+    """
+    Builds status entries which are understood by tasks.js
+    :param submission_list: list of (uuid, queue_priority, queue_seq_number) tuples
+    :param check_db: whether to look for evaluations in DB, otherwise only Redis is asked
+    :return: list of dictionaries
+    """
     response = []
-    try:
-        signer = TimestampSigner()
-        submissions = Submission.objects.filter(
-            uuid__in=[signer.unsign(i, max_age=timedelta(hours=24)) for i in rq['ids']]
-        )
-        evaluations = SubmissionEvaluation.objects.filter(submission__in=submissions)
-    except (KeyError, ValueError, signing.BadSignature, signing.SignatureExpired):
-        return JsonResponse([])
 
-    submission_list = ((str(sbm.uuid), sbm.queue_priority) for sbm in submissions)
-    evaluation_list = {str(evl.submission_id): evl for evl in evaluations}
+    if check_db:
+        evaluations = SubmissionEvaluation.objects.filter(submission_id__in=[sbm[0] for sbm in submission_list])
+        evaluation_list = {str(evl.submission_id): evl for evl in evaluations}
+    else:
+        evaluation_list = {}
+
+    try:
+        # statuses of all submissions without evaluation in DB are fetched at once
+        queue_statuses = get_submission_statuses([sbm for sbm in submission_list if sbm[0] not in evaluation_list])
+    except redis.exceptions.RedisError:
+        # maybe add some error indication here?
+        queue_statuses = {}
 
-    for sid, queued_priority in submission_list:
+    for sid, queued_priority, seq in submission_list:
         if sid not in evaluation_list:
             # we don't have evaluation result in DB
             try:
-                status_kind, data = get_submission_status(sid, queued_priority)
-            except redis.exceptions.RedisError:
-                # maybe add some error indication here?
+                status_kind, data = queue_statuses[sid]
+            except KeyError:
                 continue
 
             if status_kind == "processing":
@@ -298,7 +431,145 @@ def submission_status(request):
                 'status_color': evaluation.view_info['color']
             })
 
-    return JsonResponse(response, safe=False)
+    return response
+
+
+def get_entry_version(entry):
+    """
+    Short fingerprint of the status entry, allows the client to tell us which state it has already seen
+    """
+    return format(zlib.crc32(json.dumps(entry, sort_keys=True).encode('utf-8')), 'x')
+
+
+def get_retry_after(entries):
+    """
+    Suggests when the client should ask for the statuses again, the further in the queue the later
+    :return: time in milliseconds or None if there is nothing to wait for
+    """
+    intervals = []
+
+    for entry in entries:
+        if entry['state'] == 0:
+            intervals.append(min(
+                SUBMISSION_STATUS_POLLING['max_interval'],
+                SUBMISSION_STATUS_POLLING['min_interval'] +
+                (entry['position'] - 1) * SUBMISSION_STATUS_POLLING['position_step']
+            ))
+        elif entry['state'] == 1:
+            intervals.append(SUBMISSION_STATUS_POLLING['min_interval'])
+
+    return min(intervals) if intervals else None
+
+
+@require_POST
+@login_required
+@csrf_exempt
+def submission_status(request):
+    try:
+        rq = json.loads(request.body.decode('utf-8'))
+    except UnicodeDecodeError:
+        return JsonResponse([])
+
+    try:
+        submission_list = get_signed_submissions(rq['ids'])
+    except (KeyError, TypeError, ValueError, signing.BadSignature, signing.SignatureExpired):
+        return JsonResponse([])
+
+    entries = get_status_entries(submission_list)
+    versions = rq.get('versions')
+
+    if not isinstance(versions, dict):
+        # client which is not aware of versions receives the full list
+        return JsonResponse(entries, safe=False)
+
+    changed = []
+
+    for entry in entries:
+        entry['version'] = get_entry_version(entry)
+
+        if versions.get(entry['id']) != entry['version']:
+            changed.append(entry)
+
+    return JsonResponse({'statuses': changed, 'retry_after': get_retry_after(entries)})
+
+
+def status_event_stream(submission_list):
+    """
+    Generates Server-Sent Events with status changes of given submissions.
+    Redis is asked for the statuses whenever the worker updates the status key (requires keyspace
+    notifications to be enabled in Redis) or the poller announces stored evaluation,
+    but at least once per SUBMISSION_STATUS_STREAM['interval'] seconds.
+    """
+    pending = {sbm[0]: sbm for sbm in submission_list}
+    sent = {}
+    deadline = monotonic() + SUBMISSION_STATUS_STREAM['max_duration']
+    check_db = True
+
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+
+    try:
+        pubsub.subscribe(*[get_status_channel(sid) for sid in pending])
+        pubsub.psubscribe(*['__keyspace@*__:status:{}'.format(sid) for sid in pending])
+
+        yield 'retry: {}\n\n'.format(int(SUBMISSION_STATUS_STREAM['interval'] * 1000))
+
+        while pending and monotonic() < deadline:
+            entries = get_status_entries(list(pending.values()), check_db)
+
+            if not check_db and any(entry['state'] == -1 for entry in entries):
+                # submission has left Redis, so the evaluation is most probably already stored
+                check_db = True
+                continue
+
+            changed = [entry for entry in entries if sent.get(entry['id']) != entry]
+
+            for entry in changed:
+                sent[entry['id']] = entry
+                yield 'data: {}\n\n'.format(json.dumps(entry))
+
+                if entry['state'] == -1 or entry['state'] == 2:
+                    del pending[entry['id']]
+
+            if not pending:
+                break
+
+            if not changed:
+                # lets the server notice a disconnected client
+                yield ': keep-alive\n\n'
+
+            check_db = False
+            message = pubsub.get_message(timeout=SUBMISSION_STATUS_STREAM['interval'])
+
+            while message:
+                if message['type'] == 'message':
+                    check_db = True
+                message = pubsub.get_message()
+    except redis.exceptions.RedisError:
+        pass
+    finally:
+        pubsub.close()
+
+    yield 'event: end\ndata: {}\n\n'.format(json.dumps(list(pending)))
+
+
+@login_required
+def submission_status_stream(request):
+    if not SUBMISSION_STATUS_STREAM['enabled']:
+        raise Http404('Status stream is disabled')
+
+    try:
+        submission_list = get_signed_submissions(request.GET.getlist('id'))
+    except (ValueError, signing.BadSignature, signing.SignatureExpired):
+        return HttpResponseBadRequest()
+
+    if not submission_list:
+        return HttpResponseBadRequest()
+
+    response = StreamingHttpResponse(status_event_stream(submission_list), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # disables response buffering in nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @login_required
@@ -318,10 +589,8 @@ def user_reports(request):
         task_name=F('submission__task__name'),
         set_name=F('submission__task__tg_set__name'),
         group_name=F('submission__task__task_group__name'),
-        best=RawSQL('''dense_rank() over(partition by webapp_submission.task_id
-        order by webapp_submissionevaluation.score desc, webapp_submission.submitted desc)''', []),
-        latest=RawSQL('''dense_rank() over(partition by webapp_submission.task_id
-        order by webapp_submission.submitted desc)''', [])
+        best=Exists(TaskUserResult.objects.filter(best=OuterRef('pk'))),
+        latest=Exists(TaskUserResult.objects.filter(latest=OuterRef('pk')))
     ).order_by(
         '-submission__submitted'
     )
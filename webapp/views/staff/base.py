@@ -1,14 +1,21 @@
+import uuid
+from datetime import datetime
+
 from django.contrib.auth.models import User
 from redis.exceptions import ConnectionError as RConnectionError
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.core.exceptions import PermissionDenied
 from django.shortcuts import render, redirect
+from django.utils import timezone
+
+from algoweb.settings import QUEUE_PAGE_SIZE
 
 from webapp.forms import TaskGroupForm, TaskForm
 from webapp.models import TaskGroup, Submission, CASUserMeta
 from webapp.utils.access import item_is_staff
-from webapp.utils.redis_facade import get_worker_list, get_queue_contents
+from webapp.utils.redis_facade import get_worker_list, get_queue_lengths, get_queue_window, get_orphan_report, \
+    get_pool_metrics
 
 
 @staff_member_required
@@ -59,6 +66,15 @@ def user_list(request):
     return render(request, 'webapp/admin/user_list.html', context)
 
 
+def is_valid_uuid(value):
+    try:
+        uuid.UUID(value)
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+    return True
+
+
 @staff_member_required
 def worker_status(request):
     if not request.user.is_superuser:
@@ -70,36 +86,54 @@ def worker_status(request):
         messages.error(request, 'Unable to show worker status because there is connection problem with Redis')
         return redirect('staff_dashboard')
 
-    # UUIDs which are being checked at the moment
-    active_uuids = [item['current_uuid'] for instance, item in worker_list if item['current_uuid'] is not None]
+    summary = bool(request.GET.get('summary'))
+
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+
+    try:
+        if summary:
+            queue_items, queue_lengths = [], get_queue_lengths()
+        else:
+            queue_items, queue_lengths = get_queue_window((page - 1) * QUEUE_PAGE_SIZE, QUEUE_PAGE_SIZE)
 
-    not_checked_list = Submission.objects.filter(submissionevaluation__isnull=True)\
-        .select_related('user').order_by('submitted')
+        orphan_report = get_orphan_report()
+    except RConnectionError:
+        messages.error(request, 'Unable to show worker status because there is connection problem with Redis')
+        return redirect('staff_dashboard')
 
-    # lookup of our database rows: uuid => row
-    subm_lookup = {str(item.uuid): item for item in not_checked_list}
+    # only the rows of the displayed items are fetched
+    displayed_uuids = [item['uuid'] for item in queue_items if is_valid_uuid(item['uuid'])]
 
-    # list of queue items with preserved priority
-    queue_list = list(get_queue_contents())
+    if orphan_report and not summary:
+        displayed_uuids.extend(orphan_report['uuids'][:QUEUE_PAGE_SIZE])
 
-    # list of UUIDs present in Redis queue
-    queue_uuids = [item['uuid'] for item in queue_list]
+    subm_lookup = {str(item.uuid): item for item in Submission.objects.filter(uuid__in=displayed_uuids)
+                   .select_related('user', 'task')}
 
     # list of tuples: (queue_item, our_db_item)
-    queue_total = [(item, dict.get(subm_lookup, item['uuid'])) for item in queue_list]
+    queue_total = [(item, subm_lookup.get(item['uuid'])) for item in queue_items]
 
-    # list of tuples: (None, our_db_item) with rows which are not present in Redis
-    not_mapped = [(None, item) for item in not_checked_list
-                  if str(item.uuid) not in queue_uuids and str(item.uuid) not in active_uuids]
+    if orphan_report:
+        orphan_report['checked'] = datetime.fromtimestamp(orphan_report['checked'], timezone.utc)
+        orphan_report['items'] = [subm_lookup[uuid] for uuid in orphan_report['uuids'][:QUEUE_PAGE_SIZE]
+                                  if uuid in subm_lookup]
 
-    # so we have two lists:
-    # not_mapped (records not present in Redis)
-    # queue_total (mapped records + records not present in our DB)
-    total_list = not_mapped + queue_total
+    queued_count = sum(queue_lengths.values())
 
     context = {
         'worker_list': worker_list,
-        'queues': total_list,
+        'queues': queue_total,
+        'queue_lengths': queue_lengths,
+        'queued_count': queued_count,
+        'orphan_report': orphan_report,
+        # each process has its own pool, so these are the connections of the process serving the page
+        'pool_metrics': get_pool_metrics(),
+        'summary': summary,
+        'page': page,
+        'has_next': page * QUEUE_PAGE_SIZE < queued_count,
         'title': 'Worker status'
     }
 
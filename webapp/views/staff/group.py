@@ -2,13 +2,13 @@ from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
 from django.db.models import F
-from django.db.models.expressions import RawSQL
+from django.db.models.expressions import Exists, OuterRef
 from django.forms import formset_factory
 from django.shortcuts import redirect, render
 
 from webapp.forms import TaskGroupForm, CopyTaskGroup, TaskGroupBulkDeadlines
 from webapp.models import TaskGroupAccess, Task, TaskGroup, TaskGroupSet, SubmissionEvaluation, \
-    CASUserMeta
+    CASUserMeta, TaskUserResult
 from webapp.utils.access import item_is_staff
 from webapp.views.staff.base import item_archive, item_edit
 
@@ -80,7 +80,8 @@ def copy(request, group_id):
         if form.is_valid():
             new_group = TaskGroup.objects.create(
                 name=form.cleaned_data['name'],
-                description=form.cleaned_data['description']
+                description=form.cleaned_data['description'],
+                max_in_flight=group.max_in_flight
             )
             new_group.save()
             # creating access to the new group
@@ -187,10 +188,8 @@ def user_reports(request, group_id, user_id):
     ).annotate(
         task_name=F('submission__task__name'),
         set_name=F('submission__task__tg_set__name'),
-        best=RawSQL('''dense_rank() over(partition by webapp_submission.task_id
-        order by webapp_submissionevaluation.score desc, webapp_submission.submitted desc)''', []),
-        latest=RawSQL('''dense_rank() over(partition by webapp_submission.task_id
-        order by webapp_submission.submitted desc)''', [])
+        best=Exists(TaskUserResult.objects.filter(best=OuterRef('pk'))),
+        latest=Exists(TaskUserResult.objects.filter(latest=OuterRef('pk')))
     ).order_by(
         '-submission__submitted'
     )
@@ -1,48 +1,93 @@
 import json
 import uuid
 
-import redis
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
+from django.core import signing
 from django.core.signing import TimestampSigner
-from django.db.models.expressions import RawSQL
-from django.http import Http404, HttpResponseRedirect
+from django.db.models import Q
+from django.db.models.expressions import Exists, OuterRef
+from django.http import Http404, HttpResponseRedirect, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import redirect, render, get_object_or_404
 from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlquote
+
+from algoweb.settings import SUBMISSION_LIST_PAGE_SIZE, SUBMISSION_STATUS_STREAM
 
 from webapp.forms import InvalidateSubmissionForm
-from webapp.models import SubmissionEvaluation, SubmissionOperation, Submission, SubmissionTest, SubmissionFile
+from webapp.models import SubmissionEvaluation, SubmissionOperation, Submission, SubmissionTest, SubmissionFile, \
+    TaskUserResult
 from webapp.utils.access import item_is_staff
-from webapp.utils.main import build_http_array, submission_operation_create, evaluation_set_validity
+from webapp.utils.main import build_http_array, submission_operation_create, evaluation_set_validity, \
+    full_output_response
 from webapp.utils.highlight import highlight_submission_files
-from webapp.utils.redis_facade import upload_submission
+from webapp.utils.reevaluation import mark_stale_reevaluation, start_reevaluation
 from webapp.utils.template import short_name
 
 
+def filter_submission_list(evaluations, task_id, filters):
+    """
+    Applies filters of the submission list
+    :param filters: dictionary (e.g. GET parameters) with optional keys:
+    'only' - 'best' or 'latest', 'status' - evaluation status, 'invalid' - '1' or '0',
+    'user' - part of the username, first name or last name
+    """
+    if filters.get('only') in ['best', 'latest']:
+        evaluations = evaluations.filter(
+            pk__in=TaskUserResult.objects.filter(task_id=task_id).values(filters['only'])
+        )
+
+    if filters.get('status'):
+        evaluations = evaluations.filter(status=filters['status'])
+
+    if filters.get('invalid') in ['0', '1']:
+        evaluations = evaluations.filter(is_invalid=filters['invalid'] == '1')
+
+    if filters.get('user'):
+        evaluations = evaluations.filter(
+            Q(submission__user__username__icontains=filters['user']) |
+            Q(submission__user__first_name__icontains=filters['user']) |
+            Q(submission__user__last_name__icontains=filters['user'])
+        )
+
+    return evaluations
+
+
+def paginate_submission_list(evaluations, cursor, page_size):
+    """
+    Keyset pagination on (submitted, uuid), so the cost of a page does not depend on its position
+    :param cursor: signed cursor received from the previous page or None for the first page
+    :return: list of evaluations and cursor of the next page (None if it is the last one)
+    :except: BadSignature, ValueError in case of invalid cursor
+    """
+    evaluations = evaluations.order_by('-submission__submitted', '-submission_id')
+
+    if cursor:
+        submitted, submission_id = signing.loads(cursor)
+        submitted = parse_datetime(submitted)
+        evaluations = evaluations.filter(
+            Q(submission__submitted__lt=submitted) |
+            Q(submission__submitted=submitted, submission__pk__lt=uuid.UUID(submission_id))
+        )
+
+    page = list(evaluations[:page_size + 1])
+
+    if len(page) <= page_size:
+        return page, None
+
+    last = page[page_size - 1]
+    return page[:page_size], signing.dumps([last.submission.submitted.isoformat(), str(last.submission_id)])
+
+
 @staff_member_required
 def list_all(request, task_id):
     task, role = item_is_staff('task', request.user, task_id)
 
-    evaluations = SubmissionEvaluation.objects.select_related(
-        'submission',
-        'submission__user'
-    ).filter(
-        submission__task_id=task_id
-    ).annotate(
-        best=RawSQL('''dense_rank() over(partition by webapp_submission.user_id
-        order by webapp_submissionevaluation.score desc, webapp_submission.submitted desc)''', []),
-        latest=RawSQL('''dense_rank() over(partition by webapp_submission.user_id
-        order by webapp_submission.submitted desc)''', [])
-    ).order_by('-submission__submitted')
-
-    context = {
-        'title': 'Submissions to {}'.format(task.name),
-        'task': task,
-        'group': task.task_group,
-        'evaluations': evaluations
-    }
+    filters = {key: request.GET.get(key, '') for key in ['only', 'status', 'invalid', 'user']}
+    current_url = '{}?{}'.format(request.path, request.GET.urlencode())
 
     if request.POST:
         s_ids = []
@@ -52,11 +97,65 @@ def list_all(request, task_id):
             for index in objects:
                 s_ids.append(objects[index]['uuid'])
 
-            redirect_to = reverse('staff_task_submissions_all', args=[task_id])
-            return submission_operation_create(request.user, action, s_ids, task_id, redirect_to)
+            return submission_operation_create(request.user, action, s_ids, task_id, current_url)
         else:
             messages.warning(request, 'Action parameter was not received or is invalid')
 
+    evaluations = filter_submission_list(SubmissionEvaluation.objects.select_related(
+        'submission',
+        'submission__user'
+    ).filter(
+        submission__task_id=task_id
+    ).annotate(
+        best=Exists(TaskUserResult.objects.filter(best=OuterRef('pk'))),
+        latest=Exists(TaskUserResult.objects.filter(latest=OuterRef('pk')))
+    ), task_id, filters)
+
+    try:
+        evaluations, next_cursor = paginate_submission_list(
+            evaluations, request.GET.get('after'), SUBMISSION_LIST_PAGE_SIZE)
+    except (signing.BadSignature, ValueError, TypeError):
+        return HttpResponseBadRequest('Invalid cursor')
+
+    next_url = None
+
+    if next_cursor:
+        query = request.GET.copy()
+        query['after'] = next_cursor
+        next_url = '{}?{}'.format(request.path, query.urlencode())
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'evaluations': [{
+                'uuid': str(evaluation.submission_id),
+                'submitted': evaluation.submission.submitted.isoformat(),
+                'user': {
+                    'id': evaluation.submission.user_id,
+                    'username': evaluation.submission.user.username,
+                    'first_name': evaluation.submission.user.first_name,
+                    'last_name': evaluation.submission.user.last_name
+                },
+                'status': evaluation.status,
+                'score': evaluation.score,
+                'is_invalid': evaluation.is_invalid,
+                'best': evaluation.best,
+                'latest': evaluation.latest,
+                'report_url': reverse('staff_submission_report', args=[evaluation.submission_id])
+            } for evaluation in evaluations],
+            'next': next_url
+        })
+
+    context = {
+        'title': 'Submissions to {}'.format(task.name),
+        'task': task,
+        'group': task.task_group,
+        'evaluations': evaluations,
+        'filters': filters,
+        'is_first_page': not request.GET.get('after'),
+        'current_url': current_url,
+        'next_url': next_url
+    }
+
     return render(request, 'webapp/admin/submission/list_all.html', context)
 
 
@@ -116,6 +215,17 @@ def report(request, submission_id):
     return render(request, 'webapp/admin/submission/report.html', context)
 
 
+@staff_member_required
+def test_output(request, test_id):
+    test = get_object_or_404(SubmissionTest.objects.select_related('evaluation__submission__task__task_group'),
+                             pk=test_id)
+
+    if test.evaluation.submission.task.task_group.check_membership(request.user) == 'user':
+        raise PermissionDenied
+
+    return full_output_response(test)
+
+
 @staff_member_required
 def operation_handle(request, task_id, sop_uuid):
     task, role = item_is_staff('task', request.user, task_id)
@@ -126,7 +236,7 @@ def operation_handle(request, task_id, sop_uuid):
 
     if redirect_to:
         rd = HttpResponseRedirect(redirect_to)
-        self_rd['Location'] += '?next={}'.format(redirect_to)
+        self_rd['Location'] += '?next={}'.format(urlquote(redirect_to))
     else:
         rd = redirect('staff_task_submissions_all', task_id=task_id)
 
@@ -160,9 +270,13 @@ def operation_handle(request, task_id, sop_uuid):
 
     if op.has_started:
         if op.action == 'reevaluate':
+            mark_stale_reevaluation(op)
             extra = json.loads(op.extra)
-            if not len(extra):
-                messages.error(request, 'The operation cannot be performed. (no pending submissions received)')
+            if op.error:
+                messages.error(request, op.error)
+            if op.finished and not len(extra):
+                if not op.error:
+                    messages.error(request, 'The operation cannot be performed. (no pending submissions received)')
                 op.delete()
                 return rd
 
@@ -181,7 +295,9 @@ def operation_handle(request, task_id, sop_uuid):
                 'title': 'Re-evaluating submission{}'.format('s' if op.is_bulk else ''),
                 'tokens': {},
                 'old_scores': {},
-                'bulk': op.is_bulk
+                'bulk': op.is_bulk,
+                'op': op,
+                'status_stream': SUBMISSION_STATUS_STREAM['enabled']
             }
 
             for e in evaluations:
@@ -208,37 +324,7 @@ def operation_handle(request, task_id, sop_uuid):
                 return rd
             # confirmation received:
             if op.action == 'reevaluate':
-                pending = []
-                for evaluation in evaluations:
-                    old_submission = evaluation.submission
-                    files = SubmissionFile.objects.filter(submission=old_submission)
-
-                    new_s = Submission.objects.create(
-                        uuid=str(uuid.uuid4()),
-                        user=evaluation.submission.user,
-                        task=task,
-                        reevaluated=True,
-                        copy_of=old_submission,
-                        invoked_by=request.user,
-                        queue_priority="low"
-                    )
-
-                    pending.append(str(new_s.uuid))
-
-                    for file in files:
-                        SubmissionFile.objects.create(submission=new_s, name=file.name, contents=file.contents)
-
-                    try:
-                        upload_submission(new_s)
-                    except redis.exceptions.RedisError:
-                        new_s.delete()
-                        op.delete()
-                        return render(request, 'webapp/submit_fail.html', {'task': task})
-
-                op.has_started = True
-                op.extra = json.dumps(pending)
-                op.save()
-
+                start_reevaluation(op, sorted({str(evaluation.submission_id) for evaluation in evaluations}))
                 return self_rd
 
             elif op.action == 'invalidate':
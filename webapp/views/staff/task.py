@@ -2,14 +2,14 @@ import json
 
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
-from django.db.models import Avg, Count
-from django.db.models.expressions import RawSQL, F, Q
+from django.db.models import Avg, Count, DurationField
+from django.db.models.expressions import Case, ExpressionWrapper, F, Q, When
 from django.http import JsonResponse
 from django.shortcuts import redirect, render
 from django.views.decorators.http import require_POST
 
 from webapp.forms import TaskForm
-from webapp.models import Task, SubmissionEvaluation, TaskGroupSet
+from webapp.models import Task, SubmissionEvaluation, TaskGroupSet, TaskUserResult
 from webapp.views.staff.base import item_archive, item_edit
 from webapp.utils.access import item_is_staff
 from webapp.utils.main import get_package_link, apply_markdown
@@ -81,27 +81,19 @@ def preview_markdown(request):
 def details(request, task_id):
     task, role = item_is_staff('task', request.user, task_id)
 
-    ids = SubmissionEvaluation.objects.annotate(
-        rank=RawSQL('''dense_rank() over(partition by webapp_submission.user_id
-        order by {}webapp_submission.submitted desc)'''.format(
-            'webapp_submissionevaluation.score desc, ' if task.result_type == 'best' else ''
-        ), [])
-    ).values(
-        'id',
-        'rank',
-        'status',
-        'received',
-        'worker_took_time',
-        'submission__submitted'
-    ).filter(submission__task_id=task_id, is_invalid=False)
+    result_ids = TaskUserResult.objects.filter(task_id=task_id).values(
+        'best' if task.result_type == 'best' else 'latest'
+    )
 
     results = SubmissionEvaluation.objects.select_related(
         'submission',
         'submission__user'
-    ).filter(pk__in=(pk['id'] for pk in ids if pk['rank'] == 1)).order_by('-score', 'submission__submitted')
+    ).filter(pk__in=result_ids).order_by('-score', 'submission__submitted')
 
     # separating staff and user submissions
-    staff_members = task.task_group.taskgroupaccess_set.filter(~Q(role='user')).values_list('user_id', flat=True)
+    staff_members = set(
+        task.task_group.taskgroupaccess_set.filter(~Q(role='user')).values_list('user_id', flat=True)
+    )
     d_results = []
     s_results = []
 
@@ -111,7 +103,18 @@ def details(request, task_id):
         else:
             s_results.append(r)
 
-    # gathering stats
+    # gathering stats, check and wait times are averaged over all the successful evaluations
+    # wait time is calculated by subtracting submit unix time and worker_took_time assuming remaining
+    # time gap to be the time spent in queue
+    timed = Q(status='ok', worker_took_time__isnull=False)
+    totals = SubmissionEvaluation.objects.filter(submission__task_id=task_id, is_invalid=False).aggregate(
+        count=Count('id'),
+        avg_took_time=Avg(Case(When(timed, then=F('worker_took_time')))),
+        avg_span=Avg(Case(When(timed, then=ExpressionWrapper(
+            F('received') - F('submission__submitted'),
+            output_field=DurationField()
+        ))), output_field=DurationField()))
+
     stats = {
         'avg_check_time': 'n/a',
         'avg_wait_time': 'n/a',
@@ -119,39 +122,25 @@ def details(request, task_id):
         'sbm_count': 0
     }
 
-    total_check = 0
-    total_wait = 0
-    index = 0
-    for i in ids:
-        try:
-            if i['status'] == 'ok' and i['worker_took_time'] is not None:
-                worker_took = i['worker_took_time'] / 1000  # ms to seconds without loosing precision
-                total_check += worker_took
-                # wait time is calculated by subtracting submit unix time and worker_took_time assuming remaining
-                # time gap to be the time spent in queue
-                total_wait += (i['received'] - i['submission__submitted']).total_seconds() - worker_took
-                index += 1
-        except KeyError:
-            pass
-
-    if index > 0:
-        stats['avg_check_time'] = format_int(round(total_check / index))
-        stats['avg_wait_time'] = format_int(round(total_wait / index))
-
-    if s_results:
-        stats.update(SubmissionEvaluation.objects.filter(
-            pk__in=(pk.id for pk in s_results)
-        ).aggregate(
-            avg_score=Avg(F('score')),
-            sbm_count=Count(F('score'))
-        ))
+    if totals['avg_took_time'] is not None:
+        worker_took = totals['avg_took_time'] / 1000  # ms to seconds without loosing precision
+        stats['avg_check_time'] = format_int(round(worker_took))
+
+        if totals['avg_span'] is not None:
+            stats['avg_wait_time'] = format_int(round(totals['avg_span'].total_seconds() - worker_took))
+
+    scores = [r.score for r in s_results if r.score is not None]
+
+    if scores:
+        stats['avg_score'] = sum(scores) / len(scores)
+        stats['sbm_count'] = len(scores)
 
     context = {
         'title': 'Task: ' + task.name,
         'task': task,
         'group': task.task_group,
         'pack_url': get_package_link(task),
-        'are_results': len(ids) > 0,
+        'are_results': totals['count'] > 0,
         's_results': s_results,
         'd_results': d_results,
         'stats': stats,